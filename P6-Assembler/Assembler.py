@@ -1,27 +1,50 @@
+import bisect
+import glob
+import hashlib
+import mmap
 import os
+import shutil
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of words in the Hack instruction memory
+ROM_SIZE = 32768
+
+def clean_line(line):
+    '''Returns an assembly line without its trailing comment and whitespace, '' for empty and comment lines. Shared by the parser backends so they accept the same input.'''
+
+    if '/' in line:
+        line = line[:line.index('/')]
+    return line.strip()
 
 class Parser:
     '''Encapsulates access to the input code. Reads an assembly language command, parses it, and provides convenient access to the command’s components
     (fields and symbols). In addition, removes all white space and comments
     '''
 
-    def __init__(self, asm_file_path):
-        '''Opens the input file/stream andgets ready to parse it.'''
+    def __init__(self, lines):
+        '''Gets ready to parse the input, any iterable of assembly lines (an open file/stream, a list of strings, a generator, ...).'''
 
-        self.asm_file = open(asm_file_path, 'r')
-        self.next_command = self.asm_file.readline()
+        self.lines = iter(lines)
+        self.next_command = next(self.lines, None)
+
+        # Source line numbers (starting at 1) of the next and current command
+        self.next_line_number = 1
+        self.line_number = 0
 
     def has_more_commands(self):
         ''' Are there more commands in the input?'''
 
-        if not self.next_command:
+        if self.next_command is None:
             return False
         
         # Deletes whitespace and comments
-        while (self.next_command.strip() == '') or (self.next_command.strip()[0] == '/'):
-            self.next_command = self.asm_file.readline()
+        while clean_line(self.next_command) == '':
+            self.next_command = next(self.lines, None)
+            self.next_line_number += 1
 
-            if not self.next_command:
+            if self.next_command is None:
                 return False
         
         return True
@@ -32,8 +55,10 @@ class Parser:
         Initially there is no current command.
         '''
 
-        self.current_command = self.next_command.strip()
-        self.next_command = self.asm_file.readline()
+        self.current_command = clean_line(self.next_command)
+        self.line_number = self.next_line_number
+        self.next_command = next(self.lines, None)
+        self.next_line_number += 1
 
     def commandType(self):
         '''Returns the type of the current command:
@@ -83,6 +108,95 @@ class Parser:
         
         return self.current_command.split(';')[-1]
 
+class MappedParser(Parser):
+    '''Parser backend for very large inputs. Memory maps the file and scans it a chunk of whole lines at a time,
+    so line boundaries, comments and whitespace are handled in bulk and memory use stays flat whatever the file size.
+    '''
+
+    chunk_size = 1 << 20
+
+    def __init__(self, asm_file_path):
+        '''Maps the input file and gets ready to scan it.'''
+
+        with open(asm_file_path, 'rb') as asm_file:
+            # Empty files can't be mapped
+            if os.fstat(asm_file.fileno()).st_size:
+                self.source = mmap.mmap(asm_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.source = b''
+
+        self.commands = self.scan()
+        self.next_command = next(self.commands, None)
+        self.line_number = 0
+
+    def scan(self):
+        '''Yields the line number and command of every command in the file, without whitespace or comments.'''
+
+        size = len(self.source)
+        position = 0
+        line_number = 0
+        while position < size:
+            # Extend the chunk to the end of its last line
+            end = position + self.chunk_size
+            if end < size:
+                newline = self.source.find(b'\n', end)
+                end = size if newline == -1 else newline + 1
+            else:
+                end = size
+
+            lines = self.source[position:end].decode().split('\n')
+            for line_number, line in enumerate(lines, line_number + 1):
+                # Remove trailing comments and whitespace, skip empty and comment lines
+                line = clean_line(line)
+                if line:
+                    yield line_number, line
+
+            # The last line of a chunk ends with a newline, so its empty remainder isn't a line
+            line_number -= 1
+            position = end
+
+    def has_more_commands(self):
+        ''' Are there more commands in the input?'''
+
+        return self.next_command is not None
+
+    def advance(self):
+        '''Makes the next scanned command the current command.'''
+
+        self.line_number, self.current_command = self.next_command
+        self.next_command = next(self.commands, None)
+
+    def close(self):
+        '''Unmaps the input file.'''
+
+        self.commands.close()
+        if isinstance(self.source, mmap.mmap):
+            self.source.close()
+
+class CommandParser(Parser):
+    '''Parser for commands that are already clean, without whitespace or comments (like the code generated by VMTranslator),
+    so assembly can be fed straight from a code generator. Line numbers count the commands.
+    '''
+
+    def __init__(self, commands):
+        '''Gets ready to parse any iterable of commands.'''
+
+        self.commands = iter(commands)
+        self.next_command = next(self.commands, None)
+        self.line_number = 0
+
+    def has_more_commands(self):
+        ''' Are there more commands in the input?'''
+
+        return self.next_command is not None
+
+    def advance(self):
+        '''Makes the next command the current command.'''
+
+        self.current_command = self.next_command
+        self.next_command = next(self.commands, None)
+        self.line_number += 1
+
 class Decoder:
     '''Translates Hack assembly language mnemonics into binary codes.'''
 
@@ -141,6 +255,14 @@ class Decoder:
             "JLE": "110",
             "JMP": "111"
         }
+
+        # Every dest=comp;jump combination mapped straight to its 16 bit code, so a C command is encoded with a single lookup
+        self.c_command_table = {}
+        for comp, comp_bits in self.c_table.items():
+            for dest, dest_bits in self.d_table.items():
+                for jump, jump_bits in self.j_table.items():
+                    command = (dest + '=' if dest else '') + comp + (';' + jump if jump else '')
+                    self.c_command_table[command] = int('111' + comp_bits + dest_bits + jump_bits, 2)
     
     def dest(self, mnemonic):
         '''Returns the binary code of the dest mnemonic.'''
@@ -157,6 +279,11 @@ class Decoder:
         
         return self.j_table[mnemonic]
 
+    def c_command(self, command):
+        '''Returns the 16 bit code of a whole C command (dest=comp;jump).'''
+
+        return self.c_command_table[command]
+
 class SymbolTable:
     '''Keeps a correspondence between symbolic labels and numeric addresses.'''
 
@@ -204,90 +331,681 @@ class SymbolTable:
         
         return self.table[symbol]
 
-def get_hack_file_path(asm_file_path):
-    filename = os.path.split(asm_file_path)[-1][:-4] + '.hack'
+def split_c_command(command):
+    '''Returns the dest, comp and jump mnemonics of a C command.'''
+
+    dest, _, comp = command.rpartition('=')
+    comp, _, jump = comp.partition(';')
+    return dest, comp, jump
+
+class Optimizer:
+    '''Removes redundant instructions from Hack assembly before it is encoded (for example the push/pop round trips and jump chains of VM translated code).
+    Works on a list of commands without whitespace or comments. The peephole pass only looks at straight line code, the control flow passes
+    work on basic blocks and the label graph.
+    '''
+
+    # Consecutive C commands on the same address that can be replaced
+    pair_table = {
+        ('M=M+1', 'AM=M-1'): ['A=M'],
+        ('M=M+1', 'M=M-1'): [],
+        ('M=M-1', 'M=M+1'): [],
+        ('M=D', 'D=M'): ['M=D']
+    }
+
+    def __init__(self):
+        '''Initialize instruction counts'''
+
+        self.n_before = 0
+        self.n_after = 0
+        self.skipped = False
+
+        # Source line number of every label, since the optimized commands no longer line up with the source
+        self.label_lines = {}
+
+        # Control flow pass counts
+        self.n_threaded = 0
+        self.n_fall_through = 0
+        self.n_unreachable = 0
+
+    def count(self, commands):
+        '''Number of instructions (A and C commands) in a list of commands.'''
+
+        return sum(1 for command in commands if command[0] != '(')
+
+    def optimize(self, commands):
+        '''Runs the optimization passes on a list of commands and returns the optimized list.'''
+
+        self.n_before = self.n_after = self.count(commands)
+
+        # Removing instructions moves every address after them, which is only safe when jumps go to labels
+        if self.has_absolute_jumps(commands):
+            self.skipped = True
+            return commands
+
+        # Control flow changes can expose new peephole patterns and the other way around, so repeat until nothing is removed
+        while True:
+            commands = self.peephole(self.thread_jumps(commands))
+            n_after = self.count(commands)
+            if n_after == self.n_after:
+                return commands
+            self.n_after = n_after
+
+    def has_absolute_jumps(self, commands):
+        '''Does the program jump to numeric ROM addresses (@23 followed by a jump) instead of labels?'''
+
+        for i in range(len(commands) - 1):
+            if commands[i][0] == '@' and commands[i][1:].isdigit() and commands[i + 1][0] not in '@(' and ';' in commands[i + 1]:
+                return True
+        return False
+
+    def report(self):
+        '''Instruction counts before and after optimization.'''
+
+        if self.skipped:
+            return f'not optimized, the program jumps to numeric addresses ({self.n_before} instructions)'
+        saved = self.n_before - self.n_after
+        percent = 100 * saved / self.n_before if self.n_before else 0
+        return (f'optimized {self.n_before} -> {self.n_after} instructions ({saved} removed, {percent:.1f}%), '
+                f'{self.n_threaded} jumps threaded, {self.n_fall_through} fall-through jumps and {self.n_unreachable} unreachable blocks removed')
+
+    def basic_blocks(self, commands):
+        '''Splits a list of commands into basic blocks. A block starts with its labels (if any) and ends with a jump or right before the next label.'''
+
+        blocks = [[]]
+        for command in commands:
+            # Labels open a new block, unless the current one has nothing but labels
+            if command[0] == '(' and any(block_command[0] != '(' for block_command in blocks[-1]):
+                blocks.append([])
+            blocks[-1].append(command)
+            if command[0] not in '@(' and ';' in command:
+                blocks.append([])
+
+        return [block for block in blocks if block]
+
+    def jump_target(self, block):
+        '''Returns the symbol a block jumps to (@symbol directly before the jump), '' for computed jumps (A=M;JMP),
+        or None if the block doesn't end with a jump (or is empty, after its fall-through jump was deleted).
+        '''
+
+        if not block or block[-1][0] in '@(' or ';' not in block[-1]:
+            return None
+        if len(block) >= 2 and block[-2][0] == '@':
+            return block[-2][1:]
+        return ''
+
+    def is_jump_reference(self, commands, i):
+        '''Is the A command at index i only used as the target of the jump after it (rather than taking the label's address as data)?'''
+
+        if i + 1 == len(commands) or commands[i + 1][0] in '@(' or ';' not in commands[i + 1]:
+            return False
+        dest, comp, jump = split_c_command(commands[i + 1])
+        return 'A' not in comp
+
+    def thread_jumps(self, commands):
+        '''Control flow passes on the basic blocks: jumps to unconditional jumps go straight to the final target,
+        jumps to the very next block are deleted, and blocks that can't be reached are removed.
+        '''
+
+        blocks = self.basic_blocks(commands)
+        labels = {} # label -> index of its block
+        for index, block in enumerate(blocks):
+            for command in block:
+                if command[0] != '(':
+                    break
+                labels[command[1:-1]] = index
+
+        # Blocks that contain nothing but @target and an unconditional jump forward to target
+        forward = {}
+        for index, block in enumerate(blocks):
+            instructions = [command for command in block if command[0] != '(']
+            if len(instructions) == 2 and instructions[0][0] == '@' and self.jump_target(block):
+                dest, comp, jump = split_c_command(instructions[1])
+                if jump == 'JMP' and not dest and instructions[0][1:] in labels:
+                    forward[index] = instructions[0][1:]
+
+        for index, block in enumerate(blocks):
+            target = self.jump_target(block)
+            if target not in labels:
+                continue
+
+            # Changing the jump changes the A register left for the next block when a conditional jump isn't taken, so that block must not read it
+            dest, comp, jump = split_c_command(block[-1])
+            next_instructions = [command for command in blocks[index + 1] if command[0] != '('] if index + 1 < len(blocks) else []
+            overwrites_a = bool(next_instructions) and next_instructions[0][0] == '@'
+
+            # Jump threading, follow chains of forwarding blocks (stopping at cycles)
+            if jump == 'JMP' or overwrites_a:
+                seen = {target}
+                while labels[target] in forward and forward[labels[target]] not in seen:
+                    target = forward[labels[target]]
+                    seen.add(target)
+                if target != block[-2][1:]:
+                    block[-2] = '@' + target
+                    self.n_threaded += 1
+
+            # Fall-through, a jump without side effects to the next block is deleted as long as the next block doesn't read the A register left by the jump
+            if labels[target] == index + 1 and not dest and overwrites_a:
+                del block[-2:]
+                self.n_fall_through += 1
+
+        return self.remove_unreachable(blocks, labels)
+
+    def remove_unreachable(self, blocks, labels):
+        '''Returns the commands of the blocks reachable from the start of the program or from a label whose address is taken as data (return addresses).'''
+
+        commands = [command for block in blocks for command in block]
+        if not blocks:
+            return commands
+
+        # Labels used as data can be jumped to through computed jumps, so they are entry points too
+        reachable = {0}
+        for i, command in enumerate(commands):
+            if command[0] == '@' and command[1:] in labels and not self.is_jump_reference(commands, i):
+                reachable.add(labels[command[1:]])
+
+        # Walk the fall-through and jump edges
+        stack = list(reachable)
+        while stack:
+            index = stack.pop()
+            block = blocks[index]
+            successors = []
+
+            target = self.jump_target(block)
+            if target:
+                # A jump to something other than a label could land anywhere, keep everything
+                if target not in labels:
+                    return commands
+                successors.append(labels[target])
+            if target is None or split_c_command(block[-1])[2] != 'JMP':
+                successors.append(index + 1)
+
+            for successor in successors:
+                if successor < len(blocks) and successor not in reachable:
+                    reachable.add(successor)
+                    stack.append(successor)
+
+        self.n_unreachable += len(blocks) - len(reachable)
+        return [command for index, block in enumerate(blocks) if index in reachable for command in block]
+
+    def peephole(self, commands):
+        '''Applies the rewrite rules until none of them matches anymore.'''
+
+        changed = True
+        while changed:
+            changed = False
+            result = []
+            for command in commands:
+                result.append(command)
+                if self.rewrite(result):
+                    changed = True
+
+            # Dead loads, checked from the end so a removed instruction can't make an earlier one look dead too soon
+            commands = []
+            for i in range(len(result) - 1, -1, -1):
+                command = result[i]
+                if command[0] != '(' and self.is_dead(command, result, i + 1):
+                    changed = True
+                    continue
+                commands.append(command)
+            commands.reverse()
+        return commands
+
+    def rewrite(self, result):
+        '''Rewrites the end of the result list in place if it ends with a redundant pattern. Returns whether it changed.'''
+
+        if len(result) < 2:
+            return False
+        previous, command = result[-2], result[-1]
+
+        # Same address loaded again while A still holds it (@X, C command that keeps A, @X)
+        if command[0] == '@' and len(result) >= 3 and result[-3] == command and previous[0] not in '@(':
+            dest, comp, jump = split_c_command(previous)
+            if 'A' not in dest and not jump:
+                result.pop()
+                return True
+
+        # Pairs of C commands that cancel out
+        if (previous, command) in self.pair_table:
+            result[-2:] = self.pair_table[(previous, command)]
+            return True
+
+        return False
+
+    def is_dead(self, command, commands, start):
+        '''Is the register written by an A command, or a C command that only writes D, overwritten before it is read?
+        Labels, jumps and the end of the program count as reads since control can continue anywhere.
+        '''
+
+        if command[0] == '@':
+            register = 'A'
+        else:
+            dest, comp, jump = split_c_command(command)
+            if dest != 'D' or jump:
+                return False
+            register = 'D'
+
+        for i in range(start, len(commands)):
+            next_command = commands[i]
+            if next_command[0] == '(':
+                return False
+            if next_command[0] == '@':
+                if register == 'A':
+                    return True
+                continue
+
+            dest, comp, jump = split_c_command(next_command)
+            # M reads and writes go through A
+            reads = comp + ('M' if 'M' in dest else '')
+            if register in reads or (register == 'A' and 'M' in reads) or jump:
+                return False
+            if register in dest:
+                return True
+        return False
+
+def optimize(lines, optimizer=None):
+    '''Parses an iterable of assembly lines (or an already created parser) and returns the optimized list of commands, which can be passed on to translate().'''
+
+    if optimizer is None:
+        optimizer = Optimizer()
+
+    parser = lines if isinstance(lines, Parser) else Parser(lines)
+    commands = []
+    while parser.has_more_commands():
+        parser.advance()
+        commands.append(parser.current_command)
+        if parser.current_command[0] == '(':
+            optimizer.label_lines[parser.symbol()] = parser.line_number
+
+    return optimizer.optimize(commands)
+
+class Cache:
+    '''On-disk cache of assembler outputs. Entries are keyed on a hash of the source content, the tool version (the assembler's own source) and the options,
+    so a hit only copies files and never parses. Least recently used entries are evicted once the cache grows past its size limit.
+    '''
+
+    def __init__(self, directory=None, max_size=256 << 20):
+        '''Uses the given directory, else $HACK_ASSEMBLER_CACHE, else ~/.cache/hack-assembler. max_size is in bytes.'''
+
+        if directory is None:
+            directory = os.environ.get('HACK_ASSEMBLER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'hack-assembler'))
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+        with open(__file__, 'rb') as tool_file:
+            self.tool_version = hashlib.sha256(tool_file.read()).hexdigest()
+
+    def key(self, asm_file_path, *options):
+        '''Hash of the tool version, the options and the content of the source file.'''
+
+        digest = hashlib.sha256(self.tool_version.encode())
+        digest.update(repr(options).encode())
+        with open(asm_file_path, 'rb') as asm_file:
+            for chunk in iter(lambda: asm_file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, key, output_paths):
+        '''Copies the cached outputs of a key to the output paths. Returns the cached number of words and report lines, or None on a miss.'''
+
+        notes_path = os.path.join(self.directory, key + '.notes')
+        entry_paths = [os.path.join(self.directory, key + os.path.splitext(path)[1]) for path in output_paths]
+        try:
+            with open(notes_path, 'r') as notes_file:
+                length, *notes = notes_file.read().split('\n')
+            for entry_path, output_path in zip(entry_paths, output_paths):
+                shutil.copyfile(entry_path, output_path)
+        except FileNotFoundError:
+            return None
+
+        # Mark as recently used, another process may have evicted the entry since it was copied (the outputs are fine either way)
+        for path in entry_paths + [notes_path]:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        return int(length), notes
+
+    def put(self, key, output_paths, length, notes):
+        '''Stores the outputs of a key, then evicts old entries if the cache is too big.
+        The entry is shared by every source with the same content, so the notes must not mention the source or output paths.
+        '''
+
+        # The notes file goes last and is what marks the entry complete. Files are written under a temporary name and renamed, so parallel builds never see half an entry
+        for path in output_paths:
+            entry_path = os.path.join(self.directory, key + os.path.splitext(path)[1])
+            shutil.copyfile(path, entry_path + '.tmp' + str(os.getpid()))
+            os.replace(entry_path + '.tmp' + str(os.getpid()), entry_path)
+
+        notes_path = os.path.join(self.directory, key + '.notes')
+        with open(notes_path + '.tmp' + str(os.getpid()), 'w') as notes_file:
+            notes_file.write('\n'.join([str(length)] + notes))
+        os.replace(notes_path + '.tmp' + str(os.getpid()), notes_path)
+
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used files until the cache fits in its size limit.'''
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+def get_hack_file_path(asm_file_path, extension='.hack'):
+    filename = os.path.split(asm_file_path)[-1][:-4] + extension
     return os.path.join('Hack', filename)
 
-def main(asm_file_path):
-    # Create parser for first pass. Create decoder and symbol table.
-    symbol_parser = Parser(asm_file_path)
+def size_report(labels, length, top=10):
+    '''Breaks the instruction count of a program down per function and per source VM file, largest first.
+    Instructions belong to the last function label before them (Class.function, without the $ of labels inside functions),
+    and a function belongs to the VM file of its class.
+    '''
+
+    functions = {}
+    function = '(no function)'
+    start = 0
+    for address, _, symbol in sorted(labels) + [(length, 0, None)]:
+        if symbol is None or ('.' in symbol and '$' not in symbol):
+            functions[function] = functions.get(function, 0) + address - start
+            function = symbol
+            start = address
+
+    files = {}
+    for function, size in functions.items():
+        file = function.split('.')[0]
+        files[file] = files.get(file, 0) + size
+
+    report = [f'ROM size: {length} of {ROM_SIZE} words ({100 * length / ROM_SIZE:.1f}%)']
+    for title, sizes in [('Largest functions:', functions), ('Per file:', files)]:
+        report.append(title)
+        for name, size in sorted(sizes.items(), key=lambda item: -item[1])[:top]:
+            report.append(f'    {size:6d} {100 * size / length if length else 0:5.1f}%  {name}')
+    return '\n'.join(report)
+
+def rom_overflow_report(labels, length, complete=True):
+    '''Error message for a program that doesn't fit in the ROM, with the size report so it's clear where to cut.'''
+
+    size = str(length) if complete else f'more than {length}'
+    return f'program needs {size} words but the Hack ROM only holds {ROM_SIZE}\n' + size_report(labels, length)
+
+def write_map(labels, length, map_file):
+    '''Writes the ROM address range of every label to an open map file, one "start end label line" row per label sorted by start address.
+    A label's range runs until the next label at a higher address (or the end of the program), line is the source line that defines it.
+    Addresses are zero padded so the rows sort the same as text and as numbers, which lets profilers binary search them (see find_label).
+    '''
+
+    labels = sorted(labels)
+    starts = sorted({address for address, _, _ in labels})
+    ends = dict(zip(starts, starts[1:] + [length]))
+
+    map_file.write(''.join([f'{address:05d} {ends[address]:05d} {symbol} {line}\n' for address, line, symbol in labels]))
+
+def read_map(map_file):
+    '''Reads an open map file into a sorted list of (start, end, label, line) tuples.'''
+
+    entries = []
+    for row in map_file:
+        start, end, symbol, line = row.split()
+        entries.append((int(start), int(end), symbol, int(line)))
+    return entries
+
+def find_label(entries, address):
+    '''Binary searches the entries of a map file for the label whose range contains a ROM address, returns the entry or None.'''
+
+    # Last entry starting at or before the address (the innermost one when labels share an address)
+    index = bisect.bisect_right(entries, (address, float('inf'))) - 1
+    if index >= 0 and address < entries[index][1]:
+        return entries[index]
+    return None
+
+def write_hack(instructions, hack_file, output_format='hack'):
+    '''Writes the 16 bit codes to an open file in one write, either as text lines of bits (hack, opened with 'w') or packed big endian words (bin, opened with 'wb').'''
+
+    if output_format == 'bin':
+        words = array('H', instructions)
+        if sys.byteorder == 'little':
+            words.byteswap()
+        hack_file.write(words.tobytes())
+    else:
+        hack_file.write(''.join([format(code, '016b') + '\n' for code in instructions]))
+
+def translate(lines, labels=None):
+    '''Translates an iterable of assembly lines (or an already created parser) into an array of 16 bit codes.
+    If a labels list is given, an (address, source line number, symbol) tuple is appended to it for every label.
+    Raises OverflowError with a size report if the program doesn't fit in the ROM.
+    '''
+
+    if labels is None:
+        labels = []
+
+    # Create parser, decoder and symbol table
+    parser = lines if isinstance(lines, Parser) else Parser(lines)
     decoder = Decoder()
     symbol_table = SymbolTable()
-    
-    # First pass, check for L commands and save their symbols address pairs to table, track command address by incrementing command number
-    command_number = 0
-    while symbol_parser.has_more_commands():
-        # Go to next command
-        symbol_parser.advance()
-
-        # Check for L command
-        if symbol_parser.commandType() == 'L_COMMAND':
-            symbol_table.add_entry(symbol_parser.symbol(), command_number)
-        else:
-            # Increment command number if A or C command
-            command_number+=1
-    symbol_parser.asm_file.close()
 
-    # Create parser for second pass
-    parser = Parser(asm_file_path)
-        
-    # Open output hack file
-    hack_file_path = get_hack_file_path(asm_file_path)
-    with open(hack_file_path, 'w') as hack_file:
-
-        # Go line by line through assembly file converting each command into its corresponding hack machine language code until no more commands
-        # Second pass, replace existing symbols with corresponding addresses from table, new symbols are added to table starting from address 16
-        var_address = 16
+    # Single pass, the input is read once into an array of 16 bit codes. L commands save their symbol address pairs to the table (the address is the current length of the list),
+    # A commands whose symbol is not known yet (forward label references and variables) are recorded and patched once every label has been seen
+    instructions = array('H')
+    unresolved = {} # symbol -> indices of the A commands that use it, in order of first use
+    try:
         while parser.has_more_commands():
             # Go to next command
             parser.advance()
-            
+
             # Get command type
             command_type = parser.commandType()
 
-            # Skip if L command
-            if command_type == 'L_COMMAND': continue
+            # Save label address, L commands are not instructions
+            if command_type == 'L_COMMAND':
+                symbol_table.add_entry(parser.symbol(), len(instructions))
+                labels.append((len(instructions), parser.line_number, parser.symbol()))
+                continue
 
-            # In case of a C command find use parser to get each mnemonic and use decoder to get its bits and combine
+            # In case of a C command look up the code of the whole command
             if command_type == 'C_COMMAND':
-                code = '111'
-
-                code += decoder.comp(parser.comp())
-                code += decoder.dest(parser.dest())
-                code += decoder.jump(parser.jump())
-            # Otherwise if A command just convert the provided number or symbol into 15 bit binary form
+                code = decoder.c_command(parser.current_command)
+            # Otherwise if A command the code is just the provided number or symbol address (leading 0 bit)
             else:
                 symbol = parser.symbol()
-                
+
                 # Check if symbol
                 if not symbol.isdigit():
-                    # Check if variable
+                    # Known labels and predefined symbols are resolved now, the rest are patched after the pass
                     if symbol_table.contains(symbol):
                         symbol = symbol_table.get_address(symbol)
                     else:
-                        # Add new variable entry and increment the address for new ones
-                        symbol_table.add_entry(symbol, var_address)
-                        symbol = var_address
-
-                        var_address+=1
+                        unresolved.setdefault(symbol, []).append(len(instructions))
+                        instructions.append(0)
+                        continue
                 else:
                     symbol = int(symbol)
-                
-                code = '0' + format(symbol, '015b')
-            
-            # Write code to hack file
-            hack_file.write(code + '\n')
-    parser.asm_file.close()
+
+                code = symbol
+
+            instructions.append(code)
+    except OverflowError as error:
+        # Addresses past 16 bits don't fit the array, by then the program is far beyond the ROM (otherwise it's a constant that is too big)
+        if len(instructions) <= ROM_SIZE:
+            raise
+        raise OverflowError(rom_overflow_report(labels, len(instructions), complete=False)) from error
+
+    if len(instructions) > ROM_SIZE:
+        raise OverflowError(rom_overflow_report(labels, len(instructions)))
+
+    # Backpatch, symbols defined as labels later in the file get their address, new symbols are variables starting from address 16 (in order of first use)
+    var_address = 16
+    for symbol, indices in unresolved.items():
+        if not symbol_table.contains(symbol):
+            # Add new variable entry and increment the address for new ones
+            symbol_table.add_entry(symbol, var_address)
+            var_address+=1
+
+        code = symbol_table.get_address(symbol)
+        for index in indices:
+            instructions[index] = code
+
+    return instructions
+
+def assemble(lines):
+    '''Streaming api, yields the machine words of an iterable of assembly lines (for example a file, or the output of VMTranslator.CodeWriter) without touching the filesystem.
+    Forward label references can only be resolved at the end of the input, so words are produced once the input is exhausted.
+    '''
+
+    yield from translate(lines)
+
+def assemble_file(asm_file, hack_file, output_format='hack'):
+    '''Assembles an open assembly file/stream into an open hack file/stream (text, or binary for the bin format). Returns the number of words written.'''
+
+    instructions = translate(asm_file)
+    write_hack(instructions, hack_file, output_format)
+    return len(instructions)
+
+def get_asm_files(paths):
+    '''Expands assembly files, directories (every .asm file inside) and glob patterns into a list of assembly file paths.'''
+
+    asm_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = [os.path.join(path, file) for file in sorted(os.listdir(path)) if file[-4:] == '.asm']
+        else:
+            # Paths that match nothing are kept so their error shows up in the summary
+            matches = sorted(glob.glob(path)) or [path]
+
+        for match in matches:
+            if match not in asm_files:
+                asm_files.append(match)
+    return asm_files
+
+def map_note(n_labels, map_file_path):
+    '''Report line for a written map file.'''
+
+    return f'{n_labels} labels mapped in {map_file_path}'
+
+def assemble_path(asm_file_path, output_format='hack', optimize_code=False, map_file=False, report_size=False, cache=None):
+    '''Assembles one assembly file into the Hack directory, returns the output path, number of words and a list of report lines.
+    With a cache, unchanged sources are copied from it instead of being assembled.
+    '''
+
+    # Output paths, hack file (or packed binary rom) and optional map
+    hack_file_path = get_hack_file_path(asm_file_path, '.bin' if output_format == 'bin' else '.hack')
+    output_paths = [hack_file_path]
+    if map_file:
+        map_file_path = get_hack_file_path(asm_file_path, '.map')
+        output_paths.append(map_file_path)
+
+    if cache is not None:
+        key = cache.key(asm_file_path, output_format, optimize_code, map_file, report_size)
+        cached = cache.get(key, output_paths)
+        if cached is not None:
+            length, notes = cached
+            if map_file:
+                # The map has a row per label
+                with open(map_file_path, 'r') as map_file:
+                    notes.append(map_note(sum(1 for _ in map_file), map_file_path))
+            return hack_file_path, length, notes + ['copied from cache']
+
+    # Scan the memory mapped assembly file once, the output is only opened once assembly succeeded
+    notes = []
+    labels = []
+    parser = MappedParser(asm_file_path)
+    try:
+        if optimize_code:
+            optimizer = Optimizer()
+            instructions = translate(optimize(parser, optimizer), labels)
+            labels = [(address, optimizer.label_lines[symbol], symbol) for address, _, symbol in labels]
+            notes.append(optimizer.report())
+        else:
+            instructions = translate(parser, labels)
+    finally:
+        parser.close()
+
+    if report_size:
+        notes.extend(size_report(labels, len(instructions)).split('\n'))
+
+    # Address to label map for emulators and profilers
+    if map_file:
+        with open(map_file_path, 'w') as map_file:
+            write_map(labels, len(instructions), map_file)
+
+    # Write codes
+    with open(hack_file_path, 'wb' if output_format == 'bin' else 'w') as hack_file:
+        write_hack(instructions, hack_file, output_format)
+
+    # Entries are shared by every file with the same content, so only notes that don't depend on the output paths are cached
+    if cache is not None:
+        cache.put(key, output_paths, len(instructions), notes)
+
+    if map_file:
+        notes.append(map_note(len(labels), map_file_path))
+
+    return hack_file_path, len(instructions), notes
+
+def batch(asm_file_paths, output_format='hack', jobs=None, optimize_code=False, map_file=False, report_size=False, cache=None):
+    '''Assembles many files in parallel across cores (one interpreter per worker, not per file).
+    Errors are isolated per file and reported in a single summary. Returns the paths that failed.
+    '''
+
+    failed = []
+    n_words = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(assemble_path, path, output_format, optimize_code, map_file, report_size, cache) for path in asm_file_paths]
+
+        # Results are reported in input order
+        for asm_file_path, future in zip(asm_file_paths, futures):
+            try:
+                hack_file_path, length, notes = future.result()
+            except Exception as error:
+                failed.append(asm_file_path)
+                print(f'{asm_file_path} failed: {type(error).__name__}: {error}')
+                continue
+
+            n_words += length
+            print(asm_file_path + ' translated to ' + hack_file_path)
+            for note in notes:
+                print('    ' + note)
+
+    print(f'{len(asm_file_paths) - len(failed)} of {len(asm_file_paths)} files assembled ({n_words} words), {len(failed)} failed')
+    return failed
+
+def main(asm_file_path, output_format='hack', optimize_code=False, map_file=False, report_size=False, cache=None):
+    hack_file_path, _, notes = assemble_path(asm_file_path, output_format, optimize_code, map_file, report_size, cache)
 
     print(asm_file_path + ' translated to ' + hack_file_path)
+    for note in notes:
+        print('    ' + note)
 
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser(description="Translate an assembly file into hack machine language")
-    parser.add_argument('asm_file_path', type=str, help="The input assembly file")
+    parser.add_argument('asm_file_path', type=str, nargs='+', help="The input assembly file, or several files, directories and glob patterns to assemble in parallel")
+    parser.add_argument('--format', dest='output_format', choices=['hack', 'bin'], default='hack', help="Text .hack file or packed big endian 16 bit words (.bin)")
+    parser.add_argument('-O', '--optimize', action='store_true', help="Remove redundant instructions before encoding and report instruction counts")
+    parser.add_argument('--map', dest='map_file', action='store_true', help="Also write a .map file with the ROM address range and source line of every label")
+    parser.add_argument('--size-report', dest='report_size', action='store_true', help="Report the ROM size per function and per VM file (programs that overflow the ROM always fail with this report)")
+    parser.add_argument('--cache', action='store_true', help="Reuse outputs of unchanged sources from an on-disk cache ($HACK_ASSEMBLER_CACHE or ~/.cache/hack-assembler)")
+    parser.add_argument('--cache-size', type=int, default=256, help="Cache size limit in MB, least recently used entries are evicted first")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Number of worker processes in batch mode (default: number of cores)")
     
     args = parser.parse_args()
+    cache = Cache(max_size=args.cache_size << 20) if args.cache else None
 
-    main(args.asm_file_path)
-
+    # A single file is assembled in process, anything else is a batch
+    if len(args.asm_file_path) == 1 and os.path.isfile(args.asm_file_path[0]):
+        main(args.asm_file_path[0], args.output_format, args.optimize, args.map_file, args.report_size, cache)
+    elif batch(get_asm_files(args.asm_file_path), args.output_format, args.jobs, args.optimize, args.map_file, args.report_size, cache):
+        sys.exit(1)
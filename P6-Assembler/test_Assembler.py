@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+
+import Assembler
+
+class ParserBackendTest(unittest.TestCase):
+    '''The line parser and the memory mapped parser accept the same input.'''
+
+    source = [
+        '// Computes R2 = R0 + R1',
+        '',
+        '   @R0   ',
+        'D=M // x',
+        '@R1\t// second operand',
+        'D=D+M',
+        '(STORE) // label',
+        '@R2',
+        'M=D',
+        '@STORE',
+        '0;JMP'
+    ]
+
+    def test_same_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            asm_file_path = os.path.join(directory, 'Add.asm')
+            with open(asm_file_path, 'w') as asm_file:
+                asm_file.write('\n'.join(self.source) + '\n')
+
+            line_labels = []
+            line_words = list(Assembler.translate(Assembler.Parser(self.source), line_labels))
+
+            mapped_labels = []
+            parser = Assembler.MappedParser(asm_file_path)
+            try:
+                mapped_words = list(Assembler.translate(parser, mapped_labels))
+            finally:
+                parser.close()
+
+        self.assertEqual(line_words, mapped_words)
+        self.assertEqual(line_labels, mapped_labels)
+        self.assertEqual(line_words, list(Assembler.assemble(self.source)))
+        self.assertEqual(len(line_words), 8)
+
+class OptimizerTest(unittest.TestCase):
+    '''Control flow passes on edge cases.'''
+
+    def test_empty_block_after_fall_through(self):
+        # The translation of Jack's "if (c) {}", deleting the goto to the next block leaves an empty block
+        source = [
+            '@R0', 'D=M', '@TRUE', 'D;JNE',
+            '@FALSE', '0;JMP',
+            '(TRUE)', '(FALSE)', '@R1', 'M=D',
+            '(END)', '@END', '0;JMP'
+        ]
+        commands = Assembler.optimize(source)
+
+        # Both jumps go to the next block and are deleted
+        self.assertEqual(commands, ['@R0', 'D=M', '(TRUE)', '(FALSE)', '@R1', 'M=D', '(END)', '@END', '0;JMP'])
+
+    def test_conditional_jump_keeps_a(self):
+        # The code after the conditional jump reads the A register it leaves, so the jump isn't threaded to END
+        source = [
+            '@R0', 'D=M', '@L', 'D;JGT',
+            'D=A', '@R1', 'M=D',
+            '(END)', '@END', '0;JMP',
+            '(L)', '@END', '0;JMP'
+        ]
+        commands = Assembler.optimize(source)
+
+        self.assertEqual(commands[:5], ['@R0', 'D=M', '@L', 'D;JGT', 'D=A'])
+        self.assertEqual(list(Assembler.translate(Assembler.CommandParser(commands)))[2], 9)
+
+    def test_empty_program(self):
+        optimizer = Assembler.Optimizer()
+        self.assertEqual(Assembler.optimize([], optimizer), [])
+        self.assertEqual(optimizer.n_after, 0)
+
+class CacheTest(unittest.TestCase):
+    '''Cache entries are shared by files with the same content.'''
+
+    def test_notes_name_current_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                os.mkdir('Hack')
+                for name in ['Max', 'Other']:
+                    with open(name + '.asm', 'w') as asm_file:
+                        asm_file.write('\n'.join(ParserBackendTest.source) + '\n')
+
+                cache = Assembler.Cache(os.path.join(directory, 'cache'))
+                Assembler.assemble_path('Max.asm', map_file=True, cache=cache)
+                hack_file_path, length, notes = Assembler.assemble_path('Other.asm', map_file=True, cache=cache)
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(notes, [f'1 labels mapped in {os.path.join("Hack", "Other.map")}', 'copied from cache'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,377 @@
+import os
+from VMTranslator import C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION, C_RETURN, C_CALL, MappedParser, get_vm_files
+
+# Opcodes of decoded commands, push and pop are split by how their address is found
+(PUSH_CONSTANT, PUSH_ADDRESS, PUSH_LOCAL, PUSH_ARGUMENT, PUSH_POINTER, POP_ADDRESS, POP_LOCAL, POP_ARGUMENT, POP_POINTER,
+ ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT, GOTO, IF_GOTO, CALL, FUNCTION, RETURN, HALT) = range(24)
+
+class VMInterpreter:
+    '''Runs VM programs directly, as a correctness oracle and a profiler for the translator.
+    The commands of every file are decoded once into (opcode, a, b) tuples with labels resolved to command indices, static variables to addresses
+    (from 16, in order of first use) and segments to fixed addresses or a base pointer, then executed by a single dispatch loop.
+    RAM is a list of 32K words holding unsigned 16 bit values (a list is the fastest to index one word at a time), with the same memory layout and call frames as the Hack translation.
+    Comparisons are exact, where the Hack translation compares by subtracting (which differs when the difference overflows).
+    SP, LCL and ARG are kept in local variables while running and written back to RAM when the run ends.
+    Counts the calls of every function and the VM commands executed in it (not in the functions it calls).
+    '''
+
+    # Segments with fixed addresses, and the RAM address of the base pointer of the others
+    address_table = {
+        'pointer': 3,
+        'temp': 5
+    }
+    pointer_table = {
+        'this': 3,
+        'that': 4
+    }
+
+    # Arithmetic commands by name
+    arithmetic_table = {
+        'add': ADD,
+        'sub': SUB,
+        'neg': NEG,
+        'eq': EQ,
+        'gt': GT,
+        'lt': LT,
+        'and': AND,
+        'or': OR,
+        'not': NOT
+    }
+
+    def __init__(self, file_paths):
+        '''Decodes the .vm files, in the given order'''
+
+        self.program = []
+        self.functions = [] # Names, the first entry is the code outside of functions
+        self.entries = {} # Function name -> command index
+        self.function_at = {} # Command index of a function -> its number in functions
+        self.ram = [0] * 32768
+        self.calls = []
+        self.counts = []
+        self.steps = 0
+
+        commands = []
+        scopes = []
+        for file_path in file_paths:
+            file_name = os.path.basename(file_path)[:-3]
+            scope = file_name
+            parser = MappedParser(file_path)
+            for command in parser:
+                if command.type == C_FUNCTION:
+                    scope = command.arg1
+                commands.append((command, file_name))
+                scopes.append(scope)
+            parser.close()
+        self.decode(commands, scopes)
+
+    def decode(self, commands, scopes):
+        '''Decodes the commands (with the name of their file), labels are scoped by their function (or file) like the translator does'''
+
+        # Labels point at the next command, they aren't commands of their own
+        labels = {}
+        entries = {}
+        index = 0
+        for (command, _), scope in zip(commands, scopes):
+            if command.type == C_LABEL:
+                labels[scope, command.arg1] = index
+                continue
+            if command.type == C_FUNCTION:
+                entries[command.arg1] = index
+            index += 1
+
+        self.entries = entries
+        self.functions = ['(no function)'] + list(entries)
+        self.function_at = {index: number for number, index in enumerate(entries.values(), 1)}
+
+        statics = {}
+        for (command, file_name), scope in zip(commands, scopes):
+            command_type = command.type
+            if command_type == C_LABEL:
+                continue
+
+            if command_type == C_ARITHMETIC:
+                self.program.append((self.arithmetic_table[command.arg1], 0, 0))
+            elif command_type in [C_PUSH, C_POP]:
+                self.program.append(self.decode_push_pop(command, file_name, statics))
+            elif command_type in [C_GOTO, C_IF]:
+                if (scope, command.arg1) not in labels:
+                    raise NameError(f"No Label: {command.arg1} in {scope}")
+                self.program.append((GOTO if command_type == C_GOTO else IF_GOTO, labels[scope, command.arg1], 0))
+            elif command_type == C_CALL:
+                if command.arg1 not in entries:
+                    raise NameError(f"No Function: {command.arg1}")
+                self.program.append((CALL, entries[command.arg1], command.arg2))
+            elif command_type == C_FUNCTION:
+                self.program.append((FUNCTION, command.arg2, 0))
+            elif command_type == C_RETURN:
+                self.program.append((RETURN, 0, 0))
+            else:
+                raise NameError(f"No Command Type: {command_type}")
+
+        # Loops that can never be left end the program (like Sys.halt)
+        for index, (opcode, target, _) in enumerate(self.program):
+            if opcode == GOTO and self.is_halt(target, index):
+                self.program[index] = (HALT, 0, 0)
+
+    def decode_push_pop(self, command, file_name, statics):
+        '''Decodes a push or pop, static variables get the next free address the first time they are used'''
+
+        push = command.type == C_PUSH
+        segment, index = command.arg1, command.arg2
+
+        if segment == 'constant':
+            return PUSH_CONSTANT, index, 0
+        if segment == 'static':
+            key = (file_name, index)
+            if key not in statics:
+                statics[key] = 16 + len(statics)
+            return PUSH_ADDRESS if push else POP_ADDRESS, statics[key], 0
+        if segment in self.address_table:
+            return PUSH_ADDRESS if push else POP_ADDRESS, self.address_table[segment] + index, 0
+        if segment == 'local':
+            return PUSH_LOCAL if push else POP_LOCAL, index, 0
+        if segment == 'argument':
+            return PUSH_ARGUMENT if push else POP_ARGUMENT, index, 0
+        if segment in self.pointer_table:
+            return PUSH_POINTER if push else POP_POINTER, self.pointer_table[segment], index
+        raise NameError(f"No Segment: {segment}")
+
+    def is_halt(self, target, index):
+        '''Is the goto at index the end of a loop from target that can never be left?
+        That is the case if the loop only computes on constants (so every pass is the same) and a pass doesn't branch out of it.
+        '''
+
+        if target > index:
+            return False
+
+        # Run one pass on a stack of its own (giving up on long ones)
+        stack = []
+        pc = target
+        for _ in range(100):
+            if pc == index:
+                return not stack
+            opcode, a, _ = self.program[pc]
+            pc += 1
+            if opcode == PUSH_CONSTANT:
+                stack.append(a)
+            elif opcode in [NEG, NOT] and stack:
+                stack.append(self.compute(opcode, 0, stack.pop()))
+            elif ADD <= opcode <= OR and len(stack) >= 2:
+                y = stack.pop()
+                stack.append(self.compute(opcode, stack.pop(), y))
+            elif opcode == IF_GOTO and stack:
+                if stack.pop():
+                    if not target <= a <= index:
+                        return False
+                    pc = a
+            else:
+                return False
+        return False
+
+    def compute(self, opcode, x, y):
+        '''Result of an arithmetic command on unsigned 16 bit values (x is unused by neg and not)'''
+
+        if opcode == ADD:
+            return (x + y) & 0xFFFF
+        if opcode == SUB:
+            return (x - y) & 0xFFFF
+        if opcode == NEG:
+            return -y & 0xFFFF
+        if opcode == NOT:
+            return y ^ 0xFFFF
+        if opcode == AND:
+            return x & y
+        if opcode == OR:
+            return x | y
+        # Comparisons are signed, flipping the sign bit orders signed values like unsigned ones
+        if opcode == EQ:
+            return 0xFFFF if x == y else 0
+        if opcode == GT:
+            return 0xFFFF if x ^ 0x8000 > y ^ 0x8000 else 0
+        return 0xFFFF if x ^ 0x8000 < y ^ 0x8000 else 0
+
+    def run(self, max_steps=50_000_000):
+        '''Runs the program until it halts (a loop it can't leave), runs past its last command (or Sys.init returns) or max_steps commands were executed.
+        Programs with a Sys.init start like the bootstrap of the VM specification (SP = 256, call Sys.init with a frame, as the .cmp files of chapter 8 expect), others start at their first command
+        with the pointers already in RAM (like the tests of chapter 7). Returns how the run ended, 'halted', 'finished' or 'stopped'.
+        '''
+
+        program = self.program
+        end = len(program)
+        ram = self.ram
+        function_at = self.function_at
+        calls = self.calls = [0] * len(self.functions)
+        counts = self.counts = [0] * len(self.functions)
+
+        # Functions being run, for the counts
+        function = 0
+        call_stack = []
+        mark = 0
+
+        pc = 0
+        sp, lcl, arg = ram[0], ram[1], ram[2]
+        if 'Sys.init' in self.functions:
+            sp = 256
+
+            # The return address of the bootstrap call is the end of the program
+            ram[sp:sp + 5] = [end, lcl, arg, ram[3], ram[4]]
+            sp += 5
+            arg = lcl = sp
+            pc = self.entries['Sys.init']
+            call_stack.append(function)
+            function = function_at[pc]
+            calls[function] += 1
+
+        status = 'stopped'
+        steps = 0
+        while steps < max_steps:
+            if pc >= end:
+                status = 'finished'
+                break
+            opcode, a, b = program[pc]
+            pc += 1
+            steps += 1
+
+            # Most common commands first
+            if opcode == PUSH_CONSTANT:
+                ram[sp] = a
+                sp += 1
+            elif opcode == PUSH_LOCAL:
+                ram[sp] = ram[lcl + a]
+                sp += 1
+            elif opcode == PUSH_ARGUMENT:
+                ram[sp] = ram[arg + a]
+                sp += 1
+            elif opcode == POP_ADDRESS:
+                sp -= 1
+                ram[a] = ram[sp]
+            elif opcode == PUSH_POINTER:
+                ram[sp] = ram[ram[a] + b]
+                sp += 1
+            elif opcode == IF_GOTO:
+                sp -= 1
+                if ram[sp]:
+                    pc = a
+            elif opcode == PUSH_ADDRESS:
+                ram[sp] = ram[a]
+                sp += 1
+            elif opcode == POP_LOCAL:
+                sp -= 1
+                ram[lcl + a] = ram[sp]
+            elif opcode == ADD:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] + ram[sp]) & 0xFFFF
+            elif opcode == GOTO:
+                pc = a
+            elif opcode == POP_POINTER:
+                sp -= 1
+                ram[ram[a] + b] = ram[sp]
+            elif opcode == NOT:
+                ram[sp - 1] ^= 0xFFFF
+            elif opcode == SUB:
+                sp -= 1
+                ram[sp - 1] = (ram[sp - 1] - ram[sp]) & 0xFFFF
+            elif opcode == LT:
+                sp -= 1
+                ram[sp - 1] = 0xFFFF if ram[sp - 1] ^ 0x8000 < ram[sp] ^ 0x8000 else 0
+            elif opcode == GT:
+                sp -= 1
+                ram[sp - 1] = 0xFFFF if ram[sp - 1] ^ 0x8000 > ram[sp] ^ 0x8000 else 0
+            elif opcode == EQ:
+                sp -= 1
+                ram[sp - 1] = 0xFFFF if ram[sp - 1] == ram[sp] else 0
+            elif opcode == AND:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+            elif opcode == OR:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+            elif opcode == NEG:
+                ram[sp - 1] = -ram[sp - 1] & 0xFFFF
+            elif opcode == POP_ARGUMENT:
+                sp -= 1
+                ram[arg + a] = ram[sp]
+            elif opcode == CALL:
+                # Same frame as the translation, the return address is a command index
+                ram[sp:sp + 5] = [pc, lcl, arg, ram[3], ram[4]]
+                sp += 5
+                arg = sp - b - 5
+                lcl = sp
+                pc = a
+
+                counts[function] += steps - mark
+                mark = steps
+                call_stack.append(function)
+                function = function_at[a]
+                calls[function] += 1
+            elif opcode == FUNCTION:
+                ram[sp:sp + a] = [0] * a
+                sp += a
+            elif opcode == RETURN:
+                frame = lcl
+                pc = ram[frame - 5]
+                ram[arg] = ram[sp - 1]
+                sp = arg + 1
+                ram[4], ram[3], arg, lcl = ram[frame - 1], ram[frame - 2], ram[frame - 3], ram[frame - 4]
+
+                counts[function] += steps - mark
+                mark = steps
+                function = call_stack.pop() if call_stack else 0
+            else:
+                status = 'halted'
+                break
+
+        counts[function] += steps - mark
+        ram[0], ram[1], ram[2] = sp, lcl, arg
+        self.steps = steps
+        return status
+
+    def profile(self, top=20):
+        '''Calls and VM commands executed per function, most commands first'''
+
+        report = [f'{"function":40} {"calls":>10} {"commands":>12} {"%":>6}']
+        order = sorted(range(len(self.functions)), key=lambda number: -self.counts[number])
+        for number in order[:top]:
+            if not self.counts[number]:
+                break
+            percent = 100 * self.counts[number] / self.steps if self.steps else 0
+            report.append(f'{self.functions[number]:40} {self.calls[number]:10d} {self.counts[number]:12d} {percent:6.1f}')
+        return '\n'.join(report)
+
+def main(vm_file_path, max_steps=50_000_000, top=20, presets=(), dump=None):
+    '''Runs the .vm files of a directory and prints how the run ended and the profile.
+    presets are (address, value) pairs written to RAM first, dump is a range of RAM addresses printed after the run.
+    '''
+
+    file_paths = [os.path.join(vm_file_path, file) for file in get_vm_files(vm_file_path)]
+    interpreter = VMInterpreter(file_paths)
+    for address, value in presets:
+        interpreter.ram[address] = value & 0xFFFF
+
+    status = interpreter.run(max_steps)
+    print(f'{vm_file_path} {status} after {interpreter.steps} VM commands')
+    print(interpreter.profile(top))
+    if dump is not None:
+        for address in dump:
+            value = interpreter.ram[address]
+            print(f'RAM[{address}] = {value - 0x10000 if value & 0x8000 else value}')
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the VM files of a directory and profile them per function")
+    parser.add_argument('vm_file_path', type=str, help="The input VM directory")
+    parser.add_argument('--steps', type=int, default=50_000_000, help="Stop after this many VM commands")
+    parser.add_argument('--top', type=int, default=20, help="Number of functions in the profile")
+    parser.add_argument('--set', dest='presets', nargs='*', default=[], metavar='ADDRESS=VALUE', help="RAM values to start with (like SP, LCL, ... for programs without Sys.init)")
+    parser.add_argument('--dump', metavar='START:END', help="Print this range of RAM after the run")
+
+    args = parser.parse_args()
+
+    presets = [tuple(int(part) for part in preset.split('=')) for preset in args.presets]
+    dump = None
+    if args.dump is not None:
+        start, stop = args.dump.split(':')
+        dump = range(int(start), int(stop))
+
+    main(args.vm_file_path, args.steps, args.top, presets, dump)
@@ -1,4 +1,44 @@
+import mmap
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# Command types (opcodes of parsed commands)
+C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION, C_RETURN, C_CALL, C_IF_NOT, C_STORE = range(11)
+
+# Superinstructions, fused from sequences of commands (see Fuser)
+C_INCREMENT, C_ADD_CONSTANT, C_COMPARE_GOTO, C_MOVE = range(11, 15)
+
+class Command:
+    '''A parsed VM command, its type and arguments. Arithmetic commands keep their name in arg1, numeric arguments (indices, counts) are ints.
+    Only superinstructions have a third argument. Commands are shared between identical lines, so they are never modified once created.
+    '''
+
+    __slots__ = ('type', 'arg1', 'arg2', 'arg3')
+
+    def __init__(self, command_type, arg1=None, arg2=None, arg3=None):
+        '''Creates a command'''
+
+        self.type = command_type
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.arg3 = arg3
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and (self.type, self.arg1, self.arg2, self.arg3) == (other.type, other.arg1, other.arg2, other.arg3)
+
+    def __repr__(self):
+        if self.arg3 is not None:
+            return f'Command({self.type}, {self.arg1!r}, {self.arg2!r}, {self.arg3!r})'
+        return f'Command({self.type}, {self.arg1!r}, {self.arg2!r})'
+
+    def __str__(self):
+        '''The command as VM code'''
+
+        if self.type == C_ARITHMETIC:
+            return self.arg1
+        return ' '.join([Parser.command_names[self.type]] + [str(arg) for arg in (self.arg1, self.arg2, self.arg3) if arg is not None])
 
 class Parser:
     '''Handles the parsing of a single .vm file, and encapsulates access to the input code. 
@@ -6,27 +46,56 @@ class Parser:
     In addition, it removes all white space and comments.
     '''
 
+    # Define the list of known arithmetic commands.
+    arithmetic_commands = ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]
+
+    # Name conversion table for commands
+    command_table = {
+        'push': C_PUSH,
+        'pop': C_POP,
+        'label': C_LABEL,
+        'goto': C_GOTO,
+        'if-goto': C_IF,
+        'function': C_FUNCTION,
+        'return': C_RETURN,
+        'call': C_CALL,
+
+        # Only generated by the optimizer
+        'if-not-goto': C_IF_NOT,
+        'store': C_STORE,
+
+        # Only generated by the fuser
+        'increment': C_INCREMENT,
+        'add-constant': C_ADD_CONSTANT,
+        'compare-goto': C_COMPARE_GOTO,
+        'move': C_MOVE
+    }
+    command_names = {command_type: command for command, command_type in command_table.items()}
+    command_table.update((command, C_ARITHMETIC) for command in arithmetic_commands)
+
+    # Commands with a numeric second argument
+    numeric_commands = [C_PUSH, C_POP, C_FUNCTION, C_CALL]
+
+    @classmethod
+    def parse(cls, words):
+        '''Parses a command split into its words (without whitespace or comments) into a Command'''
+
+        if words[0] not in cls.command_table:
+            raise NameError(f"No Command Type: {words[0]}")
+        command_type = cls.command_table[words[0]]
+
+        if command_type == C_ARITHMETIC:
+            return Command(command_type, words[0])
+        if command_type in cls.numeric_commands:
+            return Command(command_type, words[1], int(words[2]))
+        return Command(command_type, *words[1:2])
+
     def __init__(self, vm_file_path):
         '''Opens the input file/stream and gets ready to parse it.'''
 
         self.vm_file = open(vm_file_path, 'r')
         self.next_command = self.vm_file.readline()
 
-        # Define the list of known arithmetic commands.
-        self.arithmetic_commands = ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]
-
-        # Name conversion table for commands
-        self.command_table = {
-            'push': 'C_PUSH',
-            'pop': 'C_POP',
-            'label': 'C_LABEL',
-            'goto': 'C_GOTO',
-            'if-goto': 'C_IF',
-            'function': 'C_FUNCTION',
-            'return': 'C_RETURN',
-            'call': 'C_CALL'
-        }
-
     def has_more_commands(self):
         ''' Are there more commands in the input?'''
 
@@ -51,164 +120,658 @@ class Parser:
         # Removes comments
         self.next_command = self.next_command.split("/")[0]
 
-        # Current command is an array, its elements the command itself and arguments following
-        self.current_command = self.next_command.strip().split(" ")
+        # Current command is parsed once, its type and arguments are then read from the Command
+        self.current_command = self.parse(self.next_command.split())
         self.next_command = self.vm_file.readline()
 
     def command_type(self):
         """Returns the type of the current command."""
 
-        # Extract the current command from the input line.
-        cmd = self.current_command[0]
-        # Determine the type of the current command.
-        if cmd in self.arithmetic_commands:
-            return "C_ARITHMETIC"
-        else:
-            return self.command_table[cmd]
+        return self.current_command.type
         
     def arg1(self):
         '''Returns the first command argument, or command itself in case of the command type C_ARITHMETIC'''
 
-        if self.command_type() == 'C_ARITHMETIC':
-            return self.current_command[0]
-        return self.current_command[1]
+        return self.current_command.arg1
     
     def arg2(self):
         '''Returns the second command argument'''
 
-        return self.current_command[2]
+        return self.current_command.arg2
+
+    def close(self):
+        '''Closes the input file.'''
+
+        self.vm_file.close()
+
+class CommandParser(Parser):
+    '''Parser over already parsed commands (like the output of the optimizer).'''
+
+    def __init__(self, commands):
+        '''Gets ready to go through the commands.'''
+
+        self.commands = iter(commands)
+        self.next_command = next(self.commands, None)
+
+    def has_more_commands(self):
+        ''' Are there more commands in the input?'''
+
+        return self.next_command is not None
+
+    def advance(self):
+        '''Makes the next command the current command.'''
+
+        self.current_command = self.next_command
+        self.next_command = next(self.commands, None)
+
+    def __iter__(self):
+        '''Iterates over the remaining commands, faster than going through them with advance()'''
+
+        if self.next_command is not None:
+            yield self.next_command
+            self.next_command = None
+            yield from self.commands
+
+    def close(self):
+        '''Nothing to close.'''
+
+        pass
+
+class MappedParser(CommandParser):
+    '''Parser backend for very large inputs. Memory maps the file and scans it a chunk of whole lines at a time,
+    so line boundaries, comments and whitespace are handled in bulk and memory use stays flat whatever the file size.
+    '''
+
+    chunk_size = 1 << 20
+
+    # Most entries kept in the memo of parsed lines
+    memo_size = 1 << 12
+
+    def __init__(self, vm_file_path):
+        '''Maps the input file and gets ready to scan it.'''
+
+        with open(vm_file_path, 'rb') as vm_file:
+            # Empty files can't be mapped
+            if os.fstat(vm_file.fileno()).st_size:
+                self.source = mmap.mmap(vm_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.source = b''
+
+        self.commands = self.scan()
+        self.next_command = next(self.commands, None)
+
+    def scan(self):
+        '''Yields every command in the file as a parsed Command.
+        VM code repeats the same push, pop and arithmetic lines over and over, so those are parsed once and their Command shared (commands are never modified).
+        Labels, jumps, functions and calls are almost always unique, memoizing them would make memory grow with the input.
+        '''
+
+        # Command of the repeated lines seen so far, cleared when full so memory stays flat
+        parsed = {}
+
+        size = len(self.source)
+        position = 0
+        while position < size:
+            # Extend the chunk to the end of its last line
+            end = position + self.chunk_size
+            if end < size:
+                newline = self.source.find(b'\n', end)
+                end = size if newline == -1 else newline + 1
+            else:
+                end = size
+
+            for line in self.source[position:end].decode().split('\n'):
+                command = parsed.get(line)
+                if command is None:
+                    # Remove trailing comments, skip empty and comment lines
+                    words = (line[:line.index('/')] if '/' in line else line).split()
+                    if not words:
+                        continue
+                    command = self.parse(words)
+                    if command.type in [C_PUSH, C_POP, C_ARITHMETIC]:
+                        if len(parsed) >= self.memo_size:
+                            parsed.clear()
+                        parsed[line] = command
+                yield command
+            position = end
+
+    def close(self):
+        '''Unmaps the input file.'''
+
+        self.commands.close()
+        if isinstance(self.source, mmap.mmap):
+            self.source.close()
     
-class CodeWriter:
-    '''Translates VM commands into Hack assembly code.'''
+class LabelAllocator:
+    '''Allocates the labels of generated jumps (return addresses, comparisons).
+    Labels are namespaced by the function they are generated in (or the file, outside of functions) with a counter per namespace,
+    so every file can be translated on its own without clashes. The extra $ keeps them apart from VM labels (function$label), which can't contain one.
+    '''
 
     def __init__(self):
-        '''Initializes command conversion tables and labels'''
-
-        # For write_arithmetic
-        self.arithmetic_table = lambda: {
-            'add': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nM=D+M\n',
-            'sub': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nM=M-D\n',
-            'and': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nM=D&M\n',
-            'or': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nM=D|M\n',
-            'eq': f'@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nD=M-D\nM=-1\n@{self.jump_label}\nD;JEQ\n@SP\nA=M-1\nM=0\n({self.jump_label})\n',
-            'gt': f'@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nD=M-D\nM=-1\n@{self.jump_label}\nD;JGT\n@SP\nA=M-1\nM=0\n({self.jump_label})\n',
-            'lt': f'@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nD=M-D\nM=-1\n@{self.jump_label}\nD;JLT\n@SP\nA=M-1\nM=0\n({self.jump_label})\n',
-            'not': '@SP\nA=M-1\nM=!M\n',
-            'neg': '@SP\nA=M-1\nM=!M\nM=M+1\n'
-        }
-
-        ### For write_push_pop
-        self.jump_label = 'jumplabel0'
-
-        self.segment_table = {
-            'local': 'LCL',
-            'argument': 'ARG',
-            'this': 'THIS',
-            'that': 'THAT',
-            'pointer': '3',
-            'temp': '5',
-            'static': '16'
-        }
-
-        self.push_pop_table = lambda segment, index: {
-            'push': f'@{index}\nD=A\n@{segment}\nA=D+M\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n',
-            'pop': f'@{index}\nD=A\n@{segment}\nD=D+M\n@R13\nM=D\n@SP\nAM=M-1\nD=M\n@R13\nA=M\nM=D\n'
-        }
-        self.get_pointer_temp_code = lambda segment, index: {
-            'push': f'@{index}\nD=A\n@{segment}\nA=D+A\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n',
-            'pop': f'@{index}\nD=A\n@{segment}\nD=D+A\n@R13\nM=D\n@SP\nAM=M-1\nD=M\n@R13\nA=M\nM=D\n'
-        }
-        self.get_static_code = lambda index: {
-            'push': f'@{self.file_name}.{index}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n',
-            'pop': f'@SP\nAM=M-1\nD=M\n@{self.file_name}.{index}\nM=D\n'
-        }
-        self.get_constant_code = lambda index: f'@{index}\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'
-        ###
-
-        # For write_if
-        self.if_code = lambda label: f'@SP\nAM=M-1\nD=M\n@{self.function}${label}\nD;JNE\n'
-
-        # For write_call
-        self.return_address = 'return_address0'
-        
-        self.push_pop_pointer = lambda pointer: {
-            'push': f'@{pointer}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n',
-            'pop': f'@{pointer}\nD=A\n@R13\nM=D\n@SP\nAM=M-1\nD=M\n@R13\nA=M\nM=D\n'
-        } # Takes pointer like LCL and pushes its address onto stack, *not the value on the segment it points to
+        '''Initializes the counters'''
+
+        self.counters = {}
+
+    def new_label(self, namespace, kind):
+        '''Returns a new unique label namespace$kind$n'''
+
+        count = self.counters.get(namespace, 0)
+        self.counters[namespace] = count + 1
+        return f'{namespace}${kind}${count}'
+
+class CodeWriter:
+    '''Translates VM commands into Hack assembly code.
+    In compact mode calls, returns and comparisons jump to shared routines (emitted once after the bootstrap) instead of being inlined at every use.
+    With top of stack caching the top of the stack is kept in D between commands instead of being written back to RAM[SP] and reloaded,
+    it is only spilled to the stack at labels, jumps, calls, returns and function entries (where the stack has to be in memory).
+    '''
+
+    # Code templates, filled in with str.format (or used as they are when they have no fields)
+
+    # For write_arithmetic
+    arithmetic_table = {
+        'add': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nM=D+M\n',
+        'sub': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nM=M-D\n',
+        'and': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nM=D&M\n',
+        'or': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nM=D|M\n',
+        'eq': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nD=M-D\nM=-1\n@{label}\nD;JEQ\n@SP\nA=M-1\nM=0\n({label})\n',
+        'gt': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nD=M-D\nM=-1\n@{label}\nD;JGT\n@SP\nA=M-1\nM=0\n({label})\n',
+        'lt': '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nD=M-D\nM=-1\n@{label}\nD;JLT\n@SP\nA=M-1\nM=0\n({label})\n',
+        'not': '@SP\nA=M-1\nM=!M\n',
+        'neg': '@SP\nA=M-1\nM=!M\nM=M+1\n'
+    }
+    compact_compare_code = '@{label}\nD=A\n@R15\nM=D\n@{routine}\n0;JMP\n({label})\n'
+
+    # For top of stack caching, the computation of each command with the top of the stack in D and the value below it in M
+    cached_arithmetic_table = {
+        'add': 'D=D+M',
+        'sub': 'D=M-D',
+        'and': 'D=D&M',
+        'or': 'D=D|M',
+        'neg': 'D=-D',
+        'not': 'D=!D',
+        'eq': 'JEQ',
+        'gt': 'JGT',
+        'lt': 'JLT'
+    }
+
+    ### For write_push_pop
+
+    segment_table = {
+        'local': 'LCL',
+        'argument': 'ARG',
+        'this': 'THIS',
+        'that': 'THAT',
+        'pointer': '3',
+        'temp': '5',
+        'static': '16',
+
+        # Locals and arguments of leaf functions promoted to fixed addresses (see LeafPromoter), variables like static ones
+        'leaf': '16'
+    }
+
+    push_pop_table = {
+        'push': '@{index}\nD=A\n@{segment}\nA=D+M\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n',
+        'pop': '@{index}\nD=A\n@{segment}\nD=D+M\n@R13\nM=D\n@SP\nAM=M-1\nD=M\n@R13\nA=M\nM=D\n'
+    }
+    # Pointer and temp addresses are known at translation time (3 + index, 5 + index)
+    pointer_temp_table = {
+        'push': '@{address}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n',
+        'pop': '@SP\nAM=M-1\nD=M\n@{address}\nM=D\n'
+    }
+    static_table = {
+        'push': '@{variable}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n',
+        'pop': '@SP\nAM=M-1\nD=M\n@{variable}\nM=D\n'
+    }
+    constant_code = '@{value}\nD=A\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'
+    ###
+
+    # For write_if
+    if_code = '@SP\nAM=M-1\nD=M\n@{function}${label}\nD;JNE\n'
+
+    # Takes pointer like LCL and pushes its address onto stack, *not the value on the segment it points to
+    push_pointer_code = '@{pointer}\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'
+
+    # OS functions translated inline as intrinsics, with their number of arguments
+    intrinsic_functions = {
+        'Math.multiply': 2,
+        'Math.divide': 2,
+        'Memory.peek': 1,
+        'Memory.poke': 2
+    }
+
+    def __init__(self, compact=False, tos_cache=False, intrinsics=False):
+        '''Initializes code generation options and labels'''
+
+        self.compact = compact
+        self.intrinsics = intrinsics
+
+        # Top of stack caching, cached is true while the top of the stack is in D (and SP points to the slot it belongs in)
+        self.tos_cache = tos_cache
+        self.cached = False
+
+        # Labels for comparisons and return addresses
+        self.labels = LabelAllocator()
+        self.return_address = ''
+
+        # Code of push and pop commands that don't depend on the file (all but static), by command, segment and index
+        self.push_pop_code = {}
 
     def set_file_name(self, file_name):
         self.file_name = file_name
 
+        # Code before the first function of a file is scoped by the file name
+        self.function = file_name
+
     def write_init(self):
         '''Initializes stack pointer to 256 then calls Sys.init'''
 
         init_code = '@256\nD=A\n@SP\nM=D\n' # SP = 256
         init_code += '@Sys.init\n0;JMP\n' # call Sys.init
+
+        # Shared routines go right after the jump, where they are only reached through their labels
+        if self.compact:
+            init_code += self.write_routines()
         return init_code
 
+    def write_routines(self):
+        '''Shared call, return and comparison routines of compact mode'''
+
+        # $CALL, return address in D, function address in R13, n_args in R14
+        code = '($CALL)\n'
+        code += '@SP\nA=M\nM=D\n' # push return address
+        for pointer in ['LCL', 'ARG', 'THIS', 'THAT']:
+            code += f'@{pointer}\nD=M\n@SP\nAM=M+1\nM=D\n' # push pointer
+        code += '@SP\nMD=M+1\n@LCL\nM=D\n' # LCL = SP (after the 5 pushes)
+        code += '@R14\nD=D-M\n@5\nD=D-A\n@ARG\nM=D\n' # ARG = SP - n_args - 5
+        code += '@R13\nA=M\n0;JMP\n' # goto function
+
+        # $RETURN, same as the inline return
+        code += '($RETURN)\n' + self.write_frame_teardown()
+
+        # $EQ, $GT, $LT, return address in R15, leave true (-1) or false (0) in place of the two compared values
+        for command, jump in [('eq', 'JEQ'), ('gt', 'JGT'), ('lt', 'JLT')]:
+            code += f'(${command.upper()})\n@SP\nAM=M-1\nD=M\nA=A-1\nD=M-D\nM=-1\n@${command.upper()}_TRUE\nD;{jump}\n@SP\nA=M-1\nM=0\n'
+            code += f'(${command.upper()}_TRUE)\n@R15\nA=M\n0;JMP\n'
+        return code
+
+    def spill(self):
+        '''Writes a cached top of stack back to the stack, nothing if it isn't cached'''
+
+        if not self.cached:
+            return ''
+        self.cached = False
+        return '@SP\nAM=M+1\nA=A-1\nM=D\n'
+
+    def fill(self):
+        '''Pops the top of the stack into D (to be cached), nothing if it already is'''
+
+        if self.cached:
+            return ''
+        self.cached = True
+        return '@SP\nAM=M-1\nD=M\n'
+
     def write_arithmetic(self, command):
         '''Translates C_ARITHMETIC commands'''
 
-        code = self.arithmetic_table()[command]
+        # Compact mode comparisons work on the stack, everything else keeps its result in D
+        if self.tos_cache:
+            if not (self.compact and command in ['eq', 'gt', 'lt']):
+                return self.write_cached_arithmetic(command)
+            code = self.spill()
+        else:
+            code = ''
 
-        # Increment jump label if used
+        # Comparisons need a new jump label, in compact mode they jump to their shared routine with the return address in R15
         if command in ['eq', 'gt', 'lt']:
-            jump_number = int(self.jump_label[-1]) + 1
-            self.jump_label = self.jump_label[:-1] + str(jump_number)
+            label = self.labels.new_label(self.function, 'cmp')
+            if self.compact:
+                return code + self.compact_compare_code.format(label=label, routine='$' + command.upper())
+            return code + self.arithmetic_table[command].format(label=label)
+        return code + self.arithmetic_table[command]
 
-        return code
+    def write_cached_arithmetic(self, command):
+        '''Translates C_ARITHMETIC commands with the top of the stack (and the result) in D'''
+
+        code = self.fill()
+        operation = self.cached_arithmetic_table[command]
+
+        # Unary commands work on D alone
+        if command in ['neg', 'not']:
+            return code + f'{operation}\n'
+
+        # Comparisons branch to set D to true (-1) or false (0)
+        if command in ['eq', 'gt', 'lt']:
+            true_label = self.labels.new_label(self.function, 'cmp')
+            end_label = self.labels.new_label(self.function, 'cmp')
+            code += f'@SP\nAM=M-1\nD=M-D\n@{true_label}\nD;{operation}\nD=0\n@{end_label}\n0;JMP\n({true_label})\nD=-1\n({end_label})\n'
+            return code
+
+        # Binary commands pop the value below the top
+        return code + f'@SP\nAM=M-1\n{operation}\n'
+
+    def segment_address(self, segment, index, limit):
+        '''Selects the addressing of segment[index] for pointer segments (LCL, ARG, THIS, THAT).
+        Returns code that points A at it without touching D (@SEG then A=M for index 0, A=M+1 and A=A+1 steps for the others),
+        or None if that takes more than limit instructions and the generic sequence (index + pointer through D) is cheaper.
+        '''
+
+        if max(index + 1, 2) > limit:
+            return None
+        if index == 0:
+            return f'@{segment}\nA=M\n'
+        return f'@{segment}\nA=M+1\n' + 'A=A+1\n' * (index - 1)
 
     def write_push_pop(self, command, segment, index):
-        '''Translates C_PUSH and C_POP commands'''
+        '''Translates C_PUSH and C_POP commands (index is an int)'''
+
+        if self.tos_cache:
+            return self.write_cached_push_pop(command, segment, index)
+
+        # Static segment, the only one that depends on the file
+        if segment in ['static', 'leaf']:
+            return self.static_table[command].format(variable=self.variable(segment, index))
+
+        # The code of the others is generated once for every command, segment and index
+        key = (command, segment, index)
+        code = self.push_pop_code.get(key)
+        if code is None:
+            code = self.push_pop_code[key] = self.generate_push_pop(command, segment, index)
+        return code
+
+    def generate_push_pop(self, command, segment, index):
+        '''Code of C_PUSH and C_POP commands of all segments but static'''
 
         if segment == 'constant':
-            return self.get_constant_code(index)
+            # 0 and 1 are constants of the ALU, they don't go through D
+            if index in (0, 1):
+                return f'@SP\nA=M\nM={index}\n@SP\nM=M+1\n'
+            return self.constant_code.format(value=index)
         
         segment = self.segment_table[segment]
 
         # Pointer and Temp segments
         if segment in ['3', '5']:
-            return self.get_pointer_temp_code(segment, index)[command]
-        
-        # Static segment
-        if segment == '16':
-            return self.get_static_code(index)[command]
+            return self.pointer_temp_table[command].format(address=int(segment) + index)
         
         # LCL, ARG, THIS, THAT segments
-        return self.push_pop_table(segment, index)[command]
+        return self.write_pointer_push_pop(command, segment, index)
+
+    def variable(self, segment, index):
+        '''Assembler variable of static segment[index] (named after the file) or leaf segment[index] (shared by every leaf function, only one runs at a time)'''
+
+        if segment == 'leaf':
+            return f'$LEAF.{index}'
+        return f'{self.file_name}.{index}'
+
+    def write_pointer_push_pop(self, command, segment, index):
+        '''Translates C_PUSH and C_POP commands of the LCL, ARG, THIS and THAT segments, small indices don't need D for the address (or R13 to pop)'''
+
+        if command == 'push':
+            address = self.segment_address(segment, index, 4)
+            if address is not None:
+                return address + 'D=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n'
+        else:
+            address = self.segment_address(segment, index, 8)
+            if address is not None:
+                return '@SP\nAM=M-1\nD=M\n' + address + 'M=D\n'
+        return self.push_pop_table[command].format(segment=segment, index=index)
+
+    def write_cached_push_pop(self, command, segment, index):
+        '''Translates C_PUSH and C_POP commands with the top of the stack in D, pushes spill the old top and load the new one into D, pops store D'''
+
+        if command == 'push':
+            code = self.spill()
+            self.cached = True
+
+            # 0 and 1 are constants of the ALU
+            if segment == 'constant':
+                if index in (0, 1):
+                    return code + f'D={index}\n'
+                return code + f'@{index}\nD=A\n'
+
+            if segment in ['static', 'leaf']:
+                return code + f'@{self.variable(segment, index)}\nD=M\n'
+            segment = self.segment_table[segment]
+            if segment in ['3', '5']:
+                return code + f'@{int(segment) + index}\nD=M\n'
+            address = self.segment_address(segment, index, 4)
+            if address is not None:
+                return code + address + 'D=M\n'
+            return code + f'@{index}\nD=A\n@{segment}\nA=D+M\nD=M\n'
+
+        if segment in ['static', 'leaf']:
+            code = self.fill()
+            self.cached = False
+            return code + f'@{self.variable(segment, index)}\nM=D\n'
+        segment = self.segment_table[segment]
+
+        # Without a cached value the plain pop is shorter than filling D first
+        if not self.cached and segment not in ['3', '5']:
+            return self.write_pointer_push_pop(command, segment, index)
+
+        code = self.fill()
+        self.cached = False
+        if segment in ['3', '5']:
+            return code + f'@{int(segment) + index}\nM=D\n'
+
+        # D holds the value, so the address is either selected without D or computed into R14 while the value is saved to R13
+        address = self.segment_address(segment, index, 12)
+        if address is not None:
+            return code + address + 'M=D\n'
+        return code + f'@R13\nM=D\n@{index}\nD=A\n@{segment}\nD=D+M\n@R14\nM=D\n@R13\nD=M\n@R14\nA=M\nM=D\n'
     
     def write_label(self, label):
         '''Write function scoped labels that can be jumped to by goto commands (function$label)'''
 
-        return f'({self.function}${label})\n'
+        return self.spill() + f'({self.function}${label})\n'
     
     def write_goto(self, label):
         '''Unconditionally jump to specified label'''
 
-        return f'@{self.function}${label}\n0;JMP\n'
+        return self.spill() + f'@{self.function}${label}\n0;JMP\n'
     
     def write_if(self, label):
         '''Conditionally jump to specified label if latest stack element -1 (true) or don't if 0 (false)'''
 
-        return self.if_code(label)
+        if self.tos_cache:
+            code = self.fill()
+            self.cached = False
+            return code + f'@{self.function}${label}\nD;JNE\n'
+        return self.if_code.format(function=self.function, label=label)
+
+    def write_if_not(self, label):
+        '''Jump to specified label unless the latest stack element is -1 (true), same as not followed by if-goto.
+        not is bitwise, so any value but -1 jumps (not just 0), which matters for conditions that aren't booleans (like x & 1).
+        '''
+
+        code = self.fill()
+        self.cached = False
+        return code + f'@{self.function}${label}\nD+1;JNE\n'
+
+    def write_store(self):
+        '''Pop a value and the address below it, point that at the address and store the value there.
+        Same as pop temp 0, pop pointer 1, push temp 0, pop that 0 (the array assignment of the Jack compiler), temp 0 is left holding the value.
+        '''
+
+        code = self.fill()
+        self.cached = False
+        return code + '@R5\nM=D\n@SP\nAM=M-1\nD=M\n@THAT\nM=D\n@R5\nD=M\n@THAT\nA=M\nM=D\n'
+
+    def direct_address(self, segment, index, limit):
+        '''Code that points A at segment[index] without touching D, for every segment but constant, or None if that's too long (see segment_address())'''
+
+        if segment in ['static', 'leaf']:
+            return f'@{self.variable(segment, index)}\n'
+        segment = self.segment_table[segment]
+        if segment in ['3', '5']:
+            return f'@{int(segment) + index}\n'
+        return self.segment_address(segment, index, limit)
+
+    def write_increment(self, segment, index, delta):
+        '''Adds delta to segment[index] in place, same as push segment index, push constant delta, add, pop segment index'''
+
+        if delta == 0:
+            return ''
+        address = self.direct_address(segment, index, 8)
+
+        # Adding or subtracting 1 doesn't need D, so a cached top of the stack can stay in it
+        if address is not None and delta in (1, -1):
+            return address + ('M=M+1\n' if delta == 1 else 'M=M-1\n')
+
+        code = self.spill() + f'@{abs(delta)}\nD=A\n'
+        operation = 'M=D+M\n' if delta > 0 else 'M=M-D\n'
+        if address is not None:
+            return code + address + operation
+        return code + f'@R13\nM=D\n@{index}\nD=A\n@{self.segment_table[segment]}\nD=D+M\n@R14\nM=D\n@R13\nD=M\n@R14\nA=M\n' + operation
+
+    def write_add_constant(self, delta):
+        '''Adds delta to the top of the stack, same as push constant delta, add'''
+
+        operation = '+' if delta > 0 else '-'
+        if self.cached:
+            if abs(delta) == 1:
+                return f'D=D{operation}1\n'
+            return f'@{abs(delta)}\nD=D{operation}A\n'
+        if abs(delta) == 1:
+            return f'@SP\nA=M-1\nM=M{operation}1\n'
+        return f'@{abs(delta)}\nD=A\n@SP\nA=M-1\n' + ('M=D+M\n' if delta > 0 else 'M=M-D\n')
+
+    def write_compare_goto(self, label, jump, constant=None):
+        '''Pops two values (or one compared to a constant) and jumps to label if their difference satisfies jump (like JLT), without pushing the comparison'''
+
+        code = self.fill()
+        self.cached = False
+        if constant is None:
+            code += '@SP\nAM=M-1\nD=M-D\n'
+        elif constant == 1:
+            code += 'D=D-1\n'
+        elif constant != 0:
+            code += f'@{constant}\nD=D-A\n'
+        return code + f'@{self.function}${label}\nD;{jump}\n'
+
+    def write_move(self, segment, index, target):
+        '''Copies segment[index] (or a constant) to the target of a pop, same as push segment index, pop target'''
+
+        address = self.direct_address(target.arg1, target.arg2, 8)
+
+        # 0 and 1 are constants of the ALU
+        if segment == 'constant' and index in (0, 1) and address is not None:
+            return address + f'M={index}\n'
+
+        code = self.spill()
+        if segment == 'constant':
+            code += f'@{index}\nD=A\n'
+        else:
+            source = self.direct_address(segment, index, 4)
+            if source is None:
+                source = f'@{index}\nD=A\n@{self.segment_table[segment]}\nA=D+M\n'
+            code += source + 'D=M\n'
+
+        if address is not None:
+            return code + address + 'M=D\n'
+        return code + f'@R13\nM=D\n@{target.arg2}\nD=A\n@{self.segment_table[target.arg1]}\nD=D+M\n@R14\nM=D\n@R13\nD=M\n@R14\nA=M\nM=D\n'
     
     def write_call(self, function_name, n_args):
         '''Create a new frame for the called function with hidden arguments when returning'''
 
+        if self.intrinsics and self.intrinsic_functions.get(function_name) == n_args:
+            return self.write_intrinsic(function_name)
+        return self.write_frame_call(function_name, n_args)
+
+    def write_frame_call(self, function_name, n_args):
+        '''Translates a call that goes through a new frame (every call but intrinsics)'''
+
+        self.return_address = self.labels.new_label(self.function, 'ret')
+        code = self.spill()
+
+        # Compact mode only passes the function and n_args to the shared routine, which builds the frame
+        if self.compact:
+            code += f'@{n_args}\nD=A\n@R14\nM=D\n@{function_name}\nD=A\n@R13\nM=D\n'
+            code += f'@{self.return_address}\nD=A\n@$CALL\n0;JMP\n'
+        else:
+            code += self.write_new_frame(function_name, n_args)
+
+        # Define return address label
+        code += f'({self.return_address})\n'
+        return code
+
+    def write_intrinsic(self, function_name):
+        '''Translates a call of an OS function inline, without a frame (see intrinsic_functions). The arguments are replaced by the result like a call would.
+        Multiply and divide loop over the bits of the arguments with their variables in R13 to R15 (and the free stack slots),
+        division by zero still calls Math.divide so the OS reports the error.
+        '''
+
+        # Peek and poke are a load and a store through A
+        if function_name == 'Memory.peek':
+            if self.tos_cache:
+                return self.fill() + 'A=D\nD=M\n'
+            return '@SP\nA=M-1\nA=M\nD=M\n@SP\nA=M-1\nM=D\n'
+        if function_name == 'Memory.poke':
+            if self.tos_cache:
+                # The result (0) is cached in the slot of the address
+                code = self.fill()
+                return code + '@SP\nAM=M-1\nA=M\nM=D\nD=0\n'
+            return '@SP\nAM=M-1\nD=M\n@SP\nA=M-1\nA=M\nM=D\n@SP\nA=M-1\nM=0\n'
+
+        # Pop y into D (x stays on the stack, where the result goes)
+        code = self.fill()
+        self.cached = False
+
+        if function_name == 'Math.multiply':
+            # Shift and add, the bits of y (R14) are cleared as they are used so the loop ends after the highest one.
+            # x (R13) and the bit (R15) are doubled every step, the sum is kept in the slot of x
+            loop = self.labels.new_label(self.function, 'mul')
+            skip = self.labels.new_label(self.function, 'mul')
+            end = self.labels.new_label(self.function, 'mul')
+            code += '@R14\nM=D\n@SP\nA=M-1\nD=M\n@R13\nM=D\n@SP\nA=M-1\nM=0\n@R15\nM=1\n'
+            code += f'({loop})\n@R14\nD=M\n@{end}\nD;JEQ\n@R15\nD=D&M\n@{skip}\nD;JEQ\n'
+            code += '@R15\nD=M\n@R14\nM=M-D\n@R13\nD=M\n@SP\nA=M-1\nM=D+M\n'
+            code += f'({skip})\n@R13\nD=M\nM=D+M\n@R15\nD=M\nM=D+M\n@{loop}\n0;JMP\n({end})\n'
+            return code
+
+        # Long division of |x| (R13) by |y| (R14), one bit of the quotient per step for 16 steps.
+        # The remainder is in R15, the quotient in the slot of x, the sign of the result in the free slot of y and the step count above it
+        zero = self.labels.new_label(self.function, 'div')
+        labels = {kind: self.labels.new_label(self.function, 'div') for kind in ['x', 'y', 'loop', 'bit', 'take', 'next', 'sign', 'end']}
+        code += f'@{zero}\nD;JEQ\n@R14\nM=D\n@SP\nA=M-1\nD=M\n@R13\nM=D\n'
+
+        # Divide the absolute values (|-32768| is 32768 as an unsigned value), flipping the sign for every negative argument
+        code += f'@SP\nA=M\nM=0\n@R13\nD=M\n@{labels["x"]}\nD;JGE\n@R13\nM=-M\n@SP\nA=M\nM=!M\n({labels["x"]})\n'
+        code += f'@R14\nD=M\n@{labels["y"]}\nD;JGE\n@R14\nM=-M\n@SP\nA=M\nM=!M\n({labels["y"]})\n'
+        code += '@SP\nA=M-1\nM=0\n@R15\nM=0\n@16\nD=A\n@SP\nA=M+1\nM=D\n'
+
+        # Shift the top bit of x into the remainder, and subtract y when the remainder (unsigned) is at least y
+        code += f'({labels["loop"]})\n@R15\nD=M\nM=D+M\n@R13\nD=M\n@{labels["bit"]}\nD;JGE\n@R15\nM=M+1\n({labels["bit"]})\n'
+        code += '@R13\nD=M\nM=D+M\n@SP\nA=M-1\nD=M\nM=D+M\n'
+        code += f'@R15\nD=M\n@{labels["take"]}\nD;JLT\n@R14\nD=D-M\n@{labels["next"]}\nD;JLT\n'
+        code += f'({labels["take"]})\n@R14\nD=M\n@R15\nM=M-D\n@SP\nA=M-1\nM=M+1\n'
+        code += f'({labels["next"]})\n@SP\nA=M+1\nMD=M-1\n@{labels["loop"]}\nD;JNE\n'
+        code += f'@SP\nA=M\nD=M\n@{labels["sign"]}\nD;JEQ\n@SP\nA=M-1\nM=-M\n({labels["sign"]})\n@{labels["end"]}\n0;JMP\n'
+
+        # Division by zero, put y (0, still in D) back and make the call
+        code += f'({zero})\n@SP\nAM=M+1\nA=A-1\nM=D\n'
+        code += self.write_frame_call(function_name, 2)
+        return code + f'({labels["end"]})\n'
+
+    def write_new_frame(self, function_name, n_args):
+        '''Inline frame setup of a call, pushes the return address and the caller's pointers then jumps to the function'''
+
         # push constant return_address
-        code = self.write_push_pop('push', 'constant', self.return_address)
+        code = self.constant_code.format(value=self.return_address)
 
         # push LCL
-        code += self.push_pop_pointer('LCL')['push']
+        code += self.push_pointer_code.format(pointer='LCL')
 
         # push ARG
-        code += self.push_pop_pointer('ARG')['push']
+        code += self.push_pointer_code.format(pointer='ARG')
 
         # push THIS
-        code += self.push_pop_pointer('THIS')['push']
+        code += self.push_pointer_code.format(pointer='THIS')
 
         # push THAT
-        code += self.push_pop_pointer('THAT')['push']
+        code += self.push_pointer_code.format(pointer='THAT')
 
         # ARG = SP - n_arg - 5
         code += f'@SP\nD=M\n@{n_args}\nD=D-A\n@5\nD=D-A\n@ARG\nM=D\n'
@@ -218,19 +781,19 @@ class CodeWriter:
 
         # goto function
         code += f'@{function_name}\n0;JMP\n'
-
-        # Define return address label
-        code += f'({self.return_address})\n'
-
-        # Increment return address
-        self.n_return_labels = int(self.return_address[-1]) + 1
-        self.return_address = self.return_address[:-1] + str(self.n_return_labels)
-
         return code
     
     def write_return(self):
         '''Go back to previous function by setting function info to its caller (set SP, ARG, ...), append the return value to the top of the stack replacing the first argument, and goto return address'''
 
+        code = self.spill()
+        if self.compact:
+            return code + '@$RETURN\n0;JMP\n'
+        return code + self.write_frame_teardown()
+
+    def write_frame_teardown(self):
+        '''Inline return code, restores the caller's frame and jumps to the return address'''
+
         # FRAME (R14) = LCL
         code = '@LCL\nD=M\n@R14\nM=D\n'
 
@@ -243,8 +806,8 @@ class CodeWriter:
         # SP = ARG + 1
         code += '@ARG\nD=M\n@1\nD=D+A\n@SP\nM=D\n'
 
-        # Set caller's LCL, ARG, THIS, THAT
-        for segment in ['LCL', 'ARG', 'THIS', 'THAT']:
+        # Set caller's THAT, THIS, ARG, LCL (saved in reverse order below the frame)
+        for segment in ['THAT', 'THIS', 'ARG', 'LCL']:
             code += f'@R14\nAM=M-1\nD=M\n@{segment}\nM=D\n'
         
         # goto RET
@@ -257,85 +820,972 @@ class CodeWriter:
 
         # Set current function name (for local labels and gotos), and function label for calls
         self.function = function_name
-        code = f'({function_name})\n'
+        code = self.spill() + f'({function_name})\n'
         # push 0 n times
         for _ in range(n_locals):
             code += self.write_push_pop('push', 'constant', 0)
         return code 
 
+def write_commands(writer, commands):
+    '''Translates commands (a list or the remaining commands of a parser), yields the code of each command'''
+
+    for command in commands:
+        command_type = command.type
+        
+        # Translate code based on what type it is (most common first)
+        if command_type == C_PUSH:
+            code = writer.write_push_pop('push', command.arg1, command.arg2)
+        elif command_type == C_POP:
+            code = writer.write_push_pop('pop', command.arg1, command.arg2)
+        elif command_type == C_ARITHMETIC:
+            code = writer.write_arithmetic(command.arg1)
+        elif command_type == C_CALL:
+            code = writer.write_call(command.arg1, command.arg2)
+        elif command_type == C_LABEL:
+            code = writer.write_label(command.arg1)
+        elif command_type == C_GOTO:
+            code = writer.write_goto(command.arg1)
+        elif command_type == C_IF:
+            code = writer.write_if(command.arg1)
+        elif command_type == C_IF_NOT:
+            code = writer.write_if_not(command.arg1)
+        elif command_type == C_STORE:
+            code = writer.write_store()
+        elif command_type == C_INCREMENT:
+            code = writer.write_increment(command.arg1, command.arg2, command.arg3)
+        elif command_type == C_ADD_CONSTANT:
+            code = writer.write_add_constant(command.arg1)
+        elif command_type == C_COMPARE_GOTO:
+            code = writer.write_compare_goto(command.arg1, command.arg2, command.arg3)
+        elif command_type == C_MOVE:
+            code = writer.write_move(command.arg1, command.arg2, command.arg3)
+        elif command_type == C_FUNCTION:
+            code = writer.write_function(command.arg1, command.arg2)
+        elif command_type == C_RETURN:
+            code = writer.write_return()
+        else:
+            raise NameError(f"No Command Type: {command_type}")
+        
+        yield code
+
+class Optimizer:
+    '''Rewrites a window of VM commands at a time before they are translated, with the number of VM commands and Hack instructions each rule saves.
+    Constant expressions are folded (push constant 2, push constant 3, add becomes push constant 5), branches on constants become gotos (or nothing),
+    push x followed by pop x is dropped, not followed by if-goto becomes if-not-goto, and the array assignment of the Jack compiler
+    (pop temp 0, pop pointer 1, push temp 0, pop that 0) becomes a single store.
+    '''
+
+    # Commands folded on constants, on 16 bit two's complement values
+    unary_table = {
+        'neg': lambda x: -x,
+        'not': lambda x: ~x
+    }
+    binary_table = {
+        'add': lambda x, y: x + y,
+        'sub': lambda x, y: x - y,
+        'and': lambda x, y: x & y,
+        'or': lambda x, y: x | y,
+        'eq': lambda x, y: -(x == y),
+        'gt': lambda x, y: -(x > y),
+        'lt': lambda x, y: -(x < y)
+    }
+
+    store_pattern = [Command(C_POP, 'temp', 0), Command(C_POP, 'pointer', 1), Command(C_PUSH, 'temp', 0), Command(C_POP, 'that', 0)]
+
+    rules = ['fold', 'branch', 'push-pop', 'not-if', 'store']
+
+    def __init__(self, compact=False, tos_cache=False):
+        '''Initialize counts, Hack instructions are counted with the same code generation options as the translation'''
+
+        self.n_before = 0
+        self.n_after = 0
+
+        # Rewrites, VM commands saved and Hack instructions saved per rule
+        self.stats = {rule: [0, 0, 0] for rule in self.rules}
+
+        self.writer = CodeWriter(compact, tos_cache)
+        self.writer.set_file_name('Optimizer')
+
+    def count(self, commands):
+        '''Number of Hack instructions the commands translate to (on their own, starting with an empty cache)'''
+
+        self.writer.cached = False
+        code = ''.join(write_commands(self.writer, commands)) + self.writer.spill()
+        return sum(1 for line in code.splitlines() if line[0] != '(')
+
+    def optimize(self, commands):
+        '''Runs the rules on a list of commands (of one file) and returns the optimized list.'''
+
+        self.n_before += len(commands)
+
+        # Folding can expose new patterns, so repeat until nothing changes
+        while True:
+            optimized = self.peephole(commands)
+            if len(optimized) == len(commands):
+                break
+            commands = optimized
+
+        self.n_after += len(commands)
+        return commands
+
+    def peephole(self, commands):
+        '''One pass of the rules over the commands'''
+
+        optimized = []
+        i = 0
+        while i < len(commands):
+            match = self.match(commands, i)
+            if match is None:
+                optimized.append(commands[i])
+                i += 1
+                continue
+
+            rule, length, replacement = match
+            stats = self.stats[rule]
+            stats[0] += 1
+            stats[1] += length - len(replacement)
+            stats[2] += self.count(commands[i:i + length]) - self.count(replacement)
+            optimized += replacement
+            i += length
+        return optimized
+
+    def match(self, commands, i):
+        '''Finds a rule that applies at commands[i], returns the rule, the number of commands it replaces and their replacement, or None'''
+
+        command = commands[i]
+        following = commands[i + 1:i + 4]
+
+        constant = self.constant(commands, i)
+        if constant is not None:
+            value, length = constant
+            after = commands[i + length] if i + length < len(commands) else None
+
+            # push constant a, neg or not
+            if self.arithmetic(after) in self.unary_table:
+                replacement = self.constant_commands(self.unary_table[after.arg1](value))
+                if len(replacement) < length + 1:
+                    return 'fold', length + 1, replacement
+
+            # push constant a, push constant b, add (or any binary command)
+            second = self.constant(commands, i + length)
+            if second is not None:
+                second_value, second_length = second
+                end = i + length + second_length
+                if end < len(commands) and self.arithmetic(commands[end]) in self.binary_table:
+                    replacement = self.constant_commands(self.binary_table[commands[end].arg1](value, second_value))
+                    return 'fold', end + 1 - i, replacement
+
+            # push constant a, if-goto label
+            if after is not None and after.type == C_IF:
+                return 'branch', length + 1, [Command(C_GOTO, after.arg1)] if self.wrap(value) else []
+
+        # push x, pop x
+        if command.type == C_PUSH and following and following[0].type == C_POP and (following[0].arg1, following[0].arg2) == (command.arg1, command.arg2):
+            return 'push-pop', 2, []
+
+        # not, if-goto label
+        if self.arithmetic(command) == 'not' and following and following[0].type == C_IF:
+            return 'not-if', 2, [Command(C_IF_NOT, following[0].arg1)]
+
+        # pop temp 0, pop pointer 1, push temp 0, pop that 0
+        if [command] + following == self.store_pattern:
+            return 'store', 4, [Command(C_STORE)]
+
+        return None
+
+    def arithmetic(self, command):
+        '''Name of an arithmetic command, None for other commands (or no command)'''
+
+        if command is not None and command.type == C_ARITHMETIC:
+            return command.arg1
+        return None
+
+    def constant(self, commands, i):
+        '''Value and number of commands of a constant at commands[i] (push constant a, optionally followed by neg or not), or None'''
+
+        if i >= len(commands) or commands[i].type != C_PUSH or commands[i].arg1 != 'constant':
+            return None
+        value = commands[i].arg2
+        if i + 1 < len(commands) and self.arithmetic(commands[i + 1]) in self.unary_table:
+            return self.wrap(self.unary_table[commands[i + 1].arg1](value)), 2
+        return value, 1
+
+    def wrap(self, value):
+        '''Wraps a value to a 16 bit signed integer'''
+
+        return (value + 0x8000) % 0x10000 - 0x8000
+
+    def constant_commands(self, value):
+        '''Commands that push a constant, push constant a for non negative values (constants can't be negative) otherwise followed by neg (or not for -32768)'''
+
+        value = self.wrap(value)
+        if value >= 0:
+            return [Command(C_PUSH, 'constant', value)]
+        if value == -0x8000:
+            return [Command(C_PUSH, 'constant', 32767), Command(C_ARITHMETIC, 'not')]
+        return [Command(C_PUSH, 'constant', -value), Command(C_ARITHMETIC, 'neg')]
+
+    def report(self):
+        '''VM commands before and after optimization, with the savings of every rule'''
+
+        saved = self.n_before - self.n_after
+        percent = 100 * saved / self.n_before if self.n_before else 0
+        report = f'optimized {self.n_before} -> {self.n_after} VM commands ({saved} removed, {percent:.1f}%)'
+        for rule in self.rules:
+            rewrites, commands, instructions = self.stats[rule]
+            report += f'\n  {rule}: {rewrites} rewrites, {commands} VM commands and {instructions} Hack instructions saved'
+        return report
+
+    def merge(self, other):
+        '''Adds the counts of another optimizer (of other files) to this one'''
+
+        self.n_before += other.n_before
+        self.n_after += other.n_after
+        for rule in self.rules:
+            self.stats[rule] = [count + other_count for count, other_count in zip(self.stats[rule], other.stats[rule])]
+
+class Fuser(Optimizer):
+    '''Fuses common sequences of VM commands into superinstructions with their own hand written Hack code, counting how often each pattern fires:
+    increment (push x, push constant c, add or sub, pop x) adds to x in place, add-constant (push constant c, add or sub) adds to the top of the stack,
+    compare-goto (eq, gt or lt followed by if-goto, or by not and if-goto or if-not-goto) jumps on the difference with a single D;Jxx
+    instead of pushing a boolean (also comparing to a constant pushed just before), and move (push x, pop y) copies x to y without the stack.
+    Runs after the optimizer, whose rewrites it relies on (like if-not-goto).
+    '''
+
+    rules = ['increment', 'add-constant', 'compare-goto', 'move']
+
+    # Jumps of the comparisons, when they are true and when they are false
+    jump_table = {
+        'eq': ('JEQ', 'JNE'),
+        'gt': ('JGT', 'JLE'),
+        'lt': ('JLT', 'JGE')
+    }
+
+    def match(self, commands, i):
+        '''Finds a pattern that starts at commands[i], returns the pattern, the number of commands it fuses and the superinstruction, or None'''
+
+        # comparison, branch
+        branch = self.compare_branch(commands, i)
+        if branch is not None:
+            jump, label, length = branch
+            return 'compare-goto', length, [Command(C_COMPARE_GOTO, label, jump)]
+
+        command = commands[i]
+        following = commands[i + 1:i + 4]
+        if command.type != C_PUSH or not following:
+            return None
+
+        # push x, push constant c, add or sub, pop x (or push constant c, push x, add, pop x)
+        if len(following) == 3 and following[2].type == C_POP and command.arg1 != 'constant':
+            operation = self.arithmetic(following[1])
+            target = following[2]
+            if (target.arg1, target.arg2) == (command.arg1, command.arg2) and self.plain_constant(following[0]) and operation in ['add', 'sub']:
+                delta = following[0].arg2 if operation == 'add' else -following[0].arg2
+                return 'increment', 4, [Command(C_INCREMENT, command.arg1, command.arg2, delta)]
+        if len(following) == 3 and self.plain_constant(command) and self.arithmetic(following[1]) == 'add' and following[2].type == C_POP:
+            pushed, target = following[0], following[2]
+            if pushed.type == C_PUSH and pushed.arg1 != 'constant' and (target.arg1, target.arg2) == (pushed.arg1, pushed.arg2):
+                return 'increment', 4, [Command(C_INCREMENT, pushed.arg1, pushed.arg2, command.arg2)]
+
+        if self.plain_constant(command):
+            # push constant c, add or sub
+            operation = self.arithmetic(following[0])
+            if operation in ['add', 'sub']:
+                return 'add-constant', 2, [Command(C_ADD_CONSTANT, command.arg2 if operation == 'add' else -command.arg2)]
+
+            # push constant c, comparison, branch
+            branch = self.compare_branch(commands, i + 1)
+            if branch is not None:
+                jump, label, length = branch
+                return 'compare-goto', length + 1, [Command(C_COMPARE_GOTO, label, jump, command.arg2)]
+
+        # push x, pop y
+        if following[0].type == C_POP:
+            return 'move', 2, [Command(C_MOVE, command.arg1, command.arg2, following[0])]
+
+        return None
+
+    def compare_branch(self, commands, i):
+        '''Jump, label and number of commands of a comparison followed by a branch at commands[i], or None'''
+
+        comparison = self.arithmetic(commands[i]) if i < len(commands) else None
+        if comparison not in self.jump_table:
+            return None
+        following = commands[i + 1:i + 3]
+        if following and following[0].type == C_IF:
+            return self.jump_table[comparison][0], following[0].arg1, 2
+        if following and following[0].type == C_IF_NOT:
+            return self.jump_table[comparison][1], following[0].arg1, 2
+        if len(following) == 2 and self.arithmetic(following[0]) == 'not' and following[1].type == C_IF:
+            return self.jump_table[comparison][1], following[1].arg1, 3
+        return None
+
+    def plain_constant(self, command):
+        '''Is the command a push constant (on its own, its value is never negative)'''
+
+        return command.type == C_PUSH and command.arg1 == 'constant'
+
+    def report(self):
+        '''VM commands before and after fusion, with how often each pattern fired and what it saved'''
+
+        report = f'fused {self.n_before} -> {self.n_after} VM commands'
+        for rule in self.rules:
+            fired, commands, instructions = self.stats[rule]
+            report += f'\n  {rule}: fired {fired} times, {commands} VM commands and {instructions} Hack instructions saved'
+        return report
+
+class Inliner:
+    '''Inlines small leaf functions (functions that don't call any) at their call sites, which saves the frame setup and teardown of the call.
+    The arguments and locals of an inlined function live in temp 1 to temp 7 (the Jack compiler only uses temp 0, and nothing else runs while they are live),
+    its labels are renamed apart and its returns jump to the end of the inlined code. THIS and THAT are saved and restored around it if the function sets them.
+    Call sites inside loops are inlined first, until the file has grown by the growth budget (a fraction of its commands).
+    '''
+
+    # Temp slots for arguments, locals and saved pointers
+    first_temp = 1
+    last_temp = 7
+
+    def __init__(self, functions, growth=0.2):
+        '''Candidates are given as function name -> (file name, n_locals, body) (see inline_candidates())'''
+
+        self.functions = functions
+        self.growth = growth
+
+        # Counts
+        self.n_before = 0
+        self.n_after = 0
+        self.n_sites = 0
+        self.inlined = set()
+
+    @classmethod
+    def can_inline(cls, body):
+        '''Can a function body be inlined? It can't call other functions or use the temp slots, and every return has to leave exactly the return value on its stack.
+        Checked by following the stack depth through the body (from 0 after the arguments were moved out), it has to agree wherever jumps meet.
+        '''
+
+        depth = 0
+        label_depths = {}
+        for command in body:
+            command_type = command.type
+            if command_type == C_CALL:
+                return False
+            if command_type in [C_PUSH, C_POP] and command.arg1 == 'temp' and command.arg2 >= cls.first_temp:
+                return False
+
+            # Labels are reached by falling through (if depth is known) or jumps, after a goto or return only by jumps
+            if command_type == C_LABEL:
+                known = label_depths.setdefault(command.arg1, depth)
+                if depth is not None and known != depth:
+                    return False
+                depth = known
+                continue
+
+            # Unreachable code (like a goto after a return) doesn't matter
+            if depth is None:
+                continue
+
+            if command_type == C_PUSH:
+                depth += 1
+            elif command_type in [C_POP, C_IF, C_IF_NOT] or (command_type == C_ARITHMETIC and command.arg1 not in ['neg', 'not']):
+                depth -= 1
+            elif command_type == C_RETURN:
+                if depth != 1:
+                    return False
+                depth = None
+            if depth is not None and depth < 0:
+                return False
+
+            if command_type in [C_GOTO, C_IF, C_IF_NOT]:
+                if label_depths.setdefault(command.arg1, depth) != depth:
+                    return False
+                if command_type == C_GOTO:
+                    depth = None
+
+        # The body has to end with a return (or jump), and jumps to labels that don't exist can't be followed
+        labels = {command.arg1 for command in body if command.type == C_LABEL}
+        return depth is None and all(label in labels for label in label_depths)
+
+    def inline(self, commands, file_name):
+        '''Inlines calls to the candidate functions in a list of commands (of one file), returns the new list'''
+
+        self.n_before += len(commands)
+
+        # The caller's own temp slots would be overwritten
+        if any(command.type in [C_PUSH, C_POP] and command.arg1 == 'temp' and command.arg2 >= self.first_temp for command in commands):
+            self.n_after += len(commands)
+            return commands
+
+        # Call sites that can be inlined, inside loops first then smallest first, while the budget lasts
+        loops = self.loop_commands(commands)
+        sites = [i for i, command in enumerate(commands) if command.type == C_CALL and self.fits(command, file_name)]
+        sites.sort(key=lambda i: (i not in loops, len(self.functions[commands[i].arg1][2]), i))
+        budget = self.growth * len(commands)
+        expansions = {}
+        for i in sites:
+            expansion = self.expand(commands[i], len(expansions))
+            if len(expansion) - 1 > budget:
+                continue
+            budget -= len(expansion) - 1
+            expansions[i] = expansion
+            self.inlined.add(commands[i].arg1)
+
+        inlined = []
+        for i, command in enumerate(commands):
+            inlined += expansions.get(i, [command])
+        self.n_sites += len(expansions)
+        self.n_after += len(inlined)
+        return inlined
+
+    def fits(self, call, file_name):
+        '''Can this call be inlined? The function has to be a candidate whose arguments, locals and saved pointers fit in the temp slots,
+        with its arguments all passed, and use static variables only if it's in the same file (they are named after the file).
+        '''
+
+        if call.arg1 not in self.functions:
+            return False
+        function_file, n_locals, body = self.functions[call.arg1]
+        n_args = call.arg2
+        if n_args + n_locals + len(self.saved_pointers(body)) > self.last_temp - self.first_temp + 1:
+            return False
+        for command in body:
+            if command.type in [C_PUSH, C_POP]:
+                if command.arg1 == 'argument' and command.arg2 >= n_args:
+                    return False
+                if command.arg1 == 'static' and function_file != file_name:
+                    return False
+        return True
+
+    def saved_pointers(self, body):
+        '''Pointers (0 for THIS, 1 for THAT) the body sets, which are restored after it like a return would'''
+
+        return sorted({command.arg2 for command in body if command.type == C_POP and command.arg1 == 'pointer'})
+
+    def expand(self, call, number):
+        '''Inlined code of a call, number makes its labels unique in the file'''
+
+        function, n_args = call.arg1, call.arg2
+        _, n_locals, body = self.functions[function]
+        # The empty name between the $ can't come from a VM label, so the end can't clash with the callee's labels (like end)
+        end_label = f'{function}${number}$$end'
+
+        # Arguments are popped into their slots (the last one is on top), then come the locals and the saved pointers
+        code = [Command(C_POP, 'temp', self.first_temp + i) for i in reversed(range(n_args))]
+        local_temp = self.first_temp + n_args
+        saved = {}
+        for pointer in self.saved_pointers(body):
+            saved[pointer] = local_temp + n_locals + len(saved)
+            code += [Command(C_PUSH, 'pointer', pointer), Command(C_POP, 'temp', saved[pointer])]
+        for i in range(n_locals):
+            code += [Command(C_PUSH, 'constant', 0), Command(C_POP, 'temp', local_temp + i)]
+
+        for command in body:
+            command_type = command.type
+            if command_type in [C_PUSH, C_POP] and command.arg1 == 'argument':
+                command = Command(command_type, 'temp', self.first_temp + command.arg2)
+            elif command_type in [C_PUSH, C_POP] and command.arg1 == 'local':
+                command = Command(command_type, 'temp', local_temp + command.arg2)
+            elif command_type in [C_LABEL, C_GOTO, C_IF, C_IF_NOT]:
+                # VM labels can't contain $, so renamed labels can't clash with the caller's or the end label
+                command = Command(command_type, f'{function}${number}${command.arg1}')
+            elif command_type == C_RETURN:
+                command = Command(C_GOTO, end_label)
+            code.append(command)
+
+        # The last return falls through to the end
+        if code[-1] == Command(C_GOTO, end_label):
+            code.pop()
+        if Command(C_GOTO, end_label) in code:
+            code.append(Command(C_LABEL, end_label))
+        for pointer, temp in saved.items():
+            code += [Command(C_PUSH, 'temp', temp), Command(C_POP, 'pointer', pointer)]
+        return code
+
+    def loop_commands(self, commands):
+        '''Indices of the commands inside loops (between a label and a jump back to it)'''
+
+        loops = set()
+        labels = {}
+        function = None
+        for i, command in enumerate(commands):
+            if command.type == C_FUNCTION:
+                function = command.arg1
+            elif command.type == C_LABEL:
+                labels[function, command.arg1] = i
+            elif command.type in [C_GOTO, C_IF, C_IF_NOT] and (function, command.arg1) in labels:
+                loops.update(range(labels[function, command.arg1], i))
+        return loops
+
+    def report(self):
+        '''Call sites inlined and the growth of the code'''
+
+        growth = self.n_after - self.n_before
+        percent = 100 * growth / self.n_before if self.n_before else 0
+        return f'inlined {self.n_sites} calls of {len(self.inlined)} functions, {self.n_before} -> {self.n_after} VM commands ({percent:+.1f}%)'
+
+    def merge(self, other):
+        '''Adds the counts of another inliner (of other files) to this one'''
+
+        self.n_before += other.n_before
+        self.n_after += other.n_after
+        self.n_sites += other.n_sites
+        self.inlined |= other.inlined
+
+class LeafPromoter:
+    '''Moves the locals and arguments of leaf functions (functions that don't call any) out of their frame to fixed addresses, the leaf segment.
+    Only one leaf function runs at a time, so they all share the same addresses ($LEAF.0, $LEAF.1, ...) and reach them with a direct @address.
+    Calls still build the frame as usual: a promoted function copies its arguments into its slots when it starts and zeroes its locals there instead of pushing them.
+    Arguments used only once stay in the frame, copying them would cost more than it saves.
+    '''
+
+    def __init__(self):
+        '''Initialize counts'''
+
+        self.n_functions = 0
+        self.n_locals = 0
+        self.n_arguments = 0
+
+        # Addresses needed by the largest promoted function
+        self.size = 0
+
+    def promote(self, commands):
+        '''Promotes the leaf functions in a list of commands (of one file), returns the new list'''
+
+        # Code before the first function is left as it is
+        promoted = []
+        functions = []
+        for command in commands:
+            if command.type == C_FUNCTION:
+                functions.append((command, []))
+            elif functions:
+                functions[-1][1].append(command)
+            else:
+                promoted.append(command)
+
+        for function, body in functions:
+            promoted += self.promote_function(function, body)
+        return promoted
+
+    def promote_function(self, function, body):
+        '''Commands of a function, promoted if it's a leaf function with something to promote'''
+
+        if any(command.type == C_CALL for command in body):
+            return [function] + body
+
+        # Arguments that are written or read more than once get a slot, then every local
+        uses = {}
+        for command in body:
+            if command.type in [C_PUSH, C_POP] and command.arg1 == 'argument':
+                uses[command.arg2] = uses.get(command.arg2, 0) + (1 if command.type == C_PUSH else 2)
+        arguments = sorted(index for index, count in uses.items() if count > 1)
+        n_locals = function.arg2
+        if not arguments and not n_locals:
+            return [function] + body
+
+        slots = {('argument', index): slot for slot, index in enumerate(arguments)}
+        slots.update((('local', index), len(arguments) + index) for index in range(n_locals))
+
+        # The function no longer pushes its locals, it sets up its slots
+        code = [Command(C_FUNCTION, function.arg1, 0)]
+        code += [Command(C_MOVE, 'argument', index, Command(C_POP, 'leaf', slots['argument', index])) for index in arguments]
+        code += [Command(C_MOVE, 'constant', 0, Command(C_POP, 'leaf', slots['local', index])) for index in range(n_locals)]
+        for command in body:
+            if command.type in [C_PUSH, C_POP] and (command.arg1, command.arg2) in slots:
+                command = Command(command.type, 'leaf', slots[command.arg1, command.arg2])
+            code.append(command)
+
+        self.n_functions += 1
+        self.n_locals += n_locals
+        self.n_arguments += len(arguments)
+        self.size = max(self.size, len(slots))
+        return code
+
+    def report(self):
+        '''Functions, locals and arguments promoted, and the addresses they share'''
+
+        return f'promoted {self.n_functions} leaf functions, {self.n_locals} locals and {self.n_arguments} arguments to {self.size} shared addresses'
+
+    def merge(self, other):
+        '''Adds the counts of another promoter (of other files) to this one'''
+
+        self.n_functions += other.n_functions
+        self.n_locals += other.n_locals
+        self.n_arguments += other.n_arguments
+        self.size = max(self.size, other.size)
+
+class CostAccount:
+    '''Static cost of the translated code, tagged with the VM command it came from and the function and file it belongs to.
+    Every piece of code counts its size (Hack instructions) and its best case cycles, the shortest way through it (taking jumps back over loops as few times
+    as possible, and ending at jumps out of it like gotos and calls). Totals are kept per kind of command (push and pop per segment), per function and per file.
+    '''
+
+    def __init__(self):
+        '''Commands, size and cycles per kind, function and file'''
+
+        self.kinds = {}
+        self.functions = {}
+        self.files = {}
+
+        # Costs of code seen before, most code is the same for every use of a command
+        self.costs = {}
+
+    def kind(self, command):
+        '''Kind of a command, the name of arithmetic commands, pushes and pops with their segment and the type of the others'''
+
+        if command.type == C_ARITHMETIC:
+            return command.arg1
+        if command.type in [C_PUSH, C_POP]:
+            return f'{Parser.command_names[command.type]} {command.arg1}'
+        return Parser.command_names[command.type]
+
+    def record(self, kind, function, file_name, code):
+        '''Adds the cost of a command's code'''
+
+        cost = self.costs.get(code)
+        if cost is None:
+            cost = self.costs[code] = self.cost(code)
+        for table, key in [(self.kinds, kind), (self.functions, function), (self.files, file_name)]:
+            total = table.setdefault(key, [0, 0, 0])
+            total[0] += 1
+            total[1] += cost[0]
+            total[2] += cost[1]
+
+    def cost(self, code):
+        '''Size and best case cycles of a piece of code'''
+
+        instructions = []
+        labels = {}
+        for line in code.split('\n'):
+            if not line or line[0] == '/':
+                continue
+            if line[0] == '(':
+                labels[line[1:-1]] = len(instructions)
+            else:
+                instructions.append(line)
+
+        # Breadth first through the instructions (every one takes a cycle), until falling off the end or jumping out of the code
+        size = len(instructions)
+        cycles = {0: 0}
+        queue = [0]
+        for i in queue:
+            if i == size:
+                return size, cycles[i]
+            instruction = instructions[i]
+            following = [i + 1]
+            if ';' in instruction:
+                # A jump goes to the label loaded into A before it, jumps to anything else leave the code
+                symbol = instructions[i - 1][1:] if i and instructions[i - 1][0] == '@' else None
+                if symbol not in labels:
+                    return size, cycles[i] + 1
+                following = [labels[symbol]] if instruction.endswith('JMP') else [labels[symbol], i + 1]
+            for j in following:
+                if j not in cycles:
+                    cycles[j] = cycles[i] + 1
+                    queue.append(j)
+
+        # Code that never ends (an infinite loop) runs through once
+        return size, size
+
+    def report(self, top=10):
+        '''Size and best case cycles per kind of command, function and file, largest first'''
+
+        size = sum(total[1] for total in self.files.values())
+        report = f'cost accounting: {size} Hack instructions'
+        for title, table in [('Per VM command:', self.kinds), ('Per function:', self.functions), ('Per file:', self.files)]:
+            report += f'\n  {title}\n    {"size":>8} {"%":>6} {"cycles":>8} {"count":>7} {"size/cmd":>8} {"cycles/cmd":>10}  name'
+            for name, (count, total_size, cycles) in sorted(table.items(), key=lambda item: -item[1][1])[:top]:
+                percent = 100 * total_size / size if size else 0
+                report += f'\n    {total_size:8d} {percent:6.1f} {cycles:8d} {count:7d} {total_size / count:8.1f} {cycles / count:10.1f}  {name}'
+        return report
+
+    def merge(self, other):
+        '''Adds the costs of another account (of other files) to this one'''
+
+        for table, other_table in [(self.kinds, other.kinds), (self.functions, other.functions), (self.files, other.files)]:
+            for key, (count, size, cycles) in other_table.items():
+                total = table.setdefault(key, [0, 0, 0])
+                total[0] += count
+                total[1] += size
+                total[2] += cycles
+
 def get_asm_file_path(vm_file_path):
     file_name = os.path.split(vm_file_path)[-1] + '.asm'
     return os.path.join('Assembly', file_name)
 
+def load_assembler():
+    '''Imports the Hack assembler of project 6 (next to this project), the back end for hack and bin output'''
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'P6-Assembler'))
+    import Assembler
+    return Assembler
+
 def get_vm_files(vm_file_path):
+    '''Names of the .vm files of a directory, sorted so the link order (and output) doesn't depend on the file system'''
+
     vm_files = []
     for file in os.listdir(vm_file_path):
         if file[-3:] == '.vm':
             vm_files.append(file)
-    return vm_files
+    return sorted(vm_files)
 
-def main(vm_file_path):
-    # Create writer object that translates commands
-    writer = CodeWriter()
+def call_graph(file_paths):
+    '''Reads the function and call commands of the files. Returns the functions they define, each with the set of functions it calls and its number of commands.
+    Calls outside of functions are under None.
+    '''
+
+    functions = {None: (set(), 0)}
+    for file_path in file_paths:
+        parser = MappedParser(file_path)
+        function = None
+        for command in parser:
+            if command.type == C_FUNCTION:
+                function = command.arg1
+                functions[function] = (set(), 0)
+            elif command.type == C_CALL:
+                functions[function][0].add(command.arg1)
+            calls, n_commands = functions[function]
+            functions[function] = (calls, n_commands + 1)
+        parser.close()
+    return functions
+
+def reachable_functions(functions, root='Sys.init'):
+    '''Functions that can be reached through calls from the root (the bootstrap calls Sys.init) or from code outside of functions'''
+
+    reached = {root, None}
+    stack = [root, None]
+    while stack:
+        for callee in functions.get(stack.pop(), (set(), 0))[0]:
+            if callee not in reached:
+                reached.add(callee)
+                stack.append(callee)
+    return reached
+
+def prune(commands, functions):
+    '''Drops the commands of functions that aren't in functions (code outside of functions is kept)'''
+
+    keep = True
+    for command in commands:
+        if command.type == C_FUNCTION:
+            keep = command.arg1 in functions
+        if keep:
+            yield command
+
+def inline_candidates(file_paths, max_size):
+    '''Functions of the files that can be inlined (see Inliner.can_inline()) with at most max_size commands, as name -> (file name, n_locals, body)'''
+
+    bodies = []
+    for file_path in file_paths:
+        file_name = os.path.basename(file_path)[:-3]
+        parser = MappedParser(file_path)
+        for command in parser:
+            if command.type == C_FUNCTION:
+                bodies.append((command.arg1, file_name, command.arg2, []))
+            elif bodies:
+                bodies[-1][3].append(command)
+        parser.close()
+
+    return {function: (file_name, n_locals, body) for function, file_name, n_locals, body in bodies if len(body) <= max_size and Inliner.can_inline(body)}
+
+class Translation:
+    '''The result of translating one .vm file: its code, and the passes that ran on it (for their reports), None for the ones that didn't run.'''
+
+    __slots__ = ('code', 'optimizer', 'inliner', 'fuser', 'account', 'promoter')
+
+    def __init__(self, code, optimizer=None, inliner=None, fuser=None, account=None, promoter=None):
+        '''Creates a translation'''
+
+        self.code = code
+        self.optimizer = optimizer
+        self.inliner = inliner
+        self.fuser = fuser
+        self.account = account
+        self.promoter = promoter
+
+def translate_file(file_path, *, compact=False, tos_cache=False, optimize_code=False, functions=None, inline=None, fuse=False, intrinsics=False, account_costs=False, promote_leaves=False):
+    '''Translates one .vm file on its own, returns a Translation.
+    With account_costs the code of every command is tagged with a comment naming its function and the command.
+    Only the functions in functions are translated if it's given (see reachable_functions()),
+    inline is given as the candidate functions and the growth budget (see Inliner).
+    Generated labels are scoped by the file's functions (or the file name), so files can be translated in any order or process and linked after.
+    '''
+
+    # Every file gets its own writer, the code of a file doesn't depend on the ones before it
+    writer = CodeWriter(compact, tos_cache, intrinsics)
+    optimizer = Optimizer(compact, tos_cache) if optimize_code else None
+    inliner = Inliner(*inline) if inline is not None else None
+    fuser = Fuser(compact, tos_cache) if fuse else None
+    promoter = LeafPromoter() if promote_leaves else None
+
+    # Get and set file name for writer (for static pointer variables {file_name.index})
+    file_name = os.path.basename(file_path)[:-3]
+    writer.set_file_name(file_name)
+
+    parser = MappedParser(file_path)
+    commands = parser
+    if functions is not None:
+        commands = prune(commands, functions)
+
+    # The inliner, the promoter, the optimizer and the fuser work on the whole list of commands of the file, inlined code is optimized with its caller
+    # (and a function whose calls were all inlined is a leaf function)
+    if inliner is not None:
+        commands = inliner.inline(list(commands), file_name)
+    if promoter is not None:
+        commands = promoter.promote(list(commands))
+    if optimizer is not None:
+        commands = optimizer.optimize(list(commands))
+    if fuser is not None:
+        commands = fuser.optimize(list(commands))
+
+    # Translate every command, and leave the stack in memory at the end of the file
+    if not account_costs:
+        code = ''.join(write_commands(writer, commands)) + writer.spill()
+        account = None
+    else:
+        # The writer's function is the one of the command while its code is yielded
+        account = CostAccount()
+        commands = list(commands)
+        codes = []
+        for command, command_code in zip(commands, write_commands(writer, commands)):
+            account.record(account.kind(command), writer.function, file_name, command_code)
+            codes.append(f'// {writer.function}: {command}\n' + command_code)
+        spill_code = writer.spill()
+        account.record('spill', writer.function, file_name, spill_code)
+        code = ''.join(codes) + spill_code
+
+    # Don't forget to close vm file
+    parser.close()
+    return Translation(code, optimizer, inliner, fuser, account, promoter)
+
+def translate_files(file_paths, jobs=1, **options):
+    '''Translates files with translate_file() and the given keyword options, in worker processes if there is more than one job (None for one per core).
+    Yields the results in order.
+    '''
+
+    translate = partial(translate_file, **options)
+    if jobs == 1:
+        yield from map(translate, file_paths)
+        return
+
+    # Workers translate files in any order, map() still returns them in order
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(translate, file_paths)
+
+def main(vm_file_path, *, compact=False, tos_cache=False, optimize_code=False, jobs=1, prune_functions=False, inline_size=0, inline_growth=0.2, fuse=False, output_format='asm', dump_asm=False, intrinsics=False, account_costs=False, promote_leaves=False):
+    '''Translates the .vm files of a directory into one .asm file, the options are keyword only. With more than one job (None for one per core) files are translated in worker processes,
+    either way they are linked in sorted order behind the bootstrap, so the output is the same.
+    With prune_functions, functions that can't be reached from Sys.init are left out.
+    With an inline_size, calls to leaf functions of at most that many commands are inlined until each file has grown by inline_growth (a fraction).
+    With fuse, common command sequences are translated as superinstructions, and how often each pattern fired is reported.
+    With intrinsics, calls to Math.multiply, Math.divide, Memory.peek and Memory.poke are translated inline (see CodeWriter.write_intrinsic()).
+    With account_costs, the code of every command is tagged with it and the size and best case cycles per kind of command, function and file are reported.
+    With promote_leaves, locals and arguments of leaf functions are moved to fixed addresses (see LeafPromoter).
+    With the hack or bin output format the code goes straight into the assembler in process and the machine code is written to Hack/ (see Assembler.write_hack()),
+    the .asm file is then only written with dump_asm (for debugging).
+    '''
+
+    # Create writer object that writes the bootstrap
+    writer = CodeWriter(compact, tos_cache)
     
     # Get vm files
-    vm_files = get_vm_files(vm_file_path)
-
-    # Open (and create) assembly file
+    file_paths = [os.path.join(vm_file_path, file) for file in get_vm_files(vm_file_path)]
+
+    # Link time call graph of the whole program, only programs with a Sys.init have a root to prune from
+    functions = None
+    if prune_functions:
+        graph = call_graph(file_paths)
+        if 'Sys.init' in graph:
+            functions = reachable_functions(graph)
+            dropped = [function for function in graph if function not in functions]
+            n_commands = sum(graph[function][1] for function in dropped)
+            prune_report = f'pruned {len(dropped)} of {len(graph) - 1} functions ({n_commands} VM commands) unreachable from Sys.init'
+        else:
+            prune_report = 'not pruned, the program has no Sys.init'
+
+    # Functions that can be inlined, from the whole program
+    inline = None
+    if inline_size:
+        inline = inline_candidates(file_paths, inline_size), inline_growth
+
+    # Init (bootstrap) code
+    codes = [writer.write_init()]
+    account = None
+    if account_costs:
+        account = CostAccount()
+        account.record('bootstrap', '(bootstrap)', '(bootstrap)', codes[0])
+
+    # Translate the files, and link their code in order
+    optimizer = Optimizer(compact, tos_cache) if optimize_code else None
+    inliner = Inliner(*inline) if inline is not None else None
+    fuser = Fuser(compact, tos_cache) if fuse else None
+    promoter = LeafPromoter() if promote_leaves else None
+    translations = translate_files(file_paths, jobs, compact=compact, tos_cache=tos_cache, optimize_code=optimize_code, functions=functions, inline=inline,
+                                   fuse=fuse, intrinsics=intrinsics, account_costs=account_costs, promote_leaves=promote_leaves)
+    for translation in translations:
+        codes.append(translation.code)
+        if optimizer is not None:
+            optimizer.merge(translation.optimizer)
+        if inliner is not None:
+            inliner.merge(translation.inliner)
+        if fuser is not None:
+            fuser.merge(translation.fuser)
+        if account is not None:
+            account.merge(translation.account)
+        if promoter is not None:
+            promoter.merge(translation.promoter)
+
+    # Write (and create) assembly file
     asm_file_path = get_asm_file_path(vm_file_path)
-    with open(asm_file_path, 'w') as asm_file:
-        # Write init (bootstrap) code
-        asm_file.write(writer.write_init())
-
-        # Iterate through .vm files
-        for file in vm_files:
-            # Create parser for file
-            file_path = os.path.join(vm_file_path, file)
-            parser = Parser(file_path)
-
-            # Get and set file name for writer (for static pointer variables {file_name.index})
-            writer.set_file_name(file[:-3])
-
-            # Iterate through commands in file
-            while parser.has_more_commands():
-                # Go to next command and get its type
-                parser.advance()
-                command_type = parser.command_type()
-                
-                # Translate code based on what type it is
-                if command_type == 'C_ARITHMETIC':
-                    code = writer.write_arithmetic(parser.arg1())
-                elif command_type in ['C_PUSH', 'C_POP']:
-                    code = writer.write_push_pop(*parser.current_command)
-                elif command_type == 'C_LABEL':
-                    code = writer.write_label(parser.arg1())
-                elif command_type == 'C_GOTO':
-                    code = writer.write_goto(parser.arg1())
-                elif command_type == 'C_IF':
-                    code = writer.write_if(parser.arg1())
-                elif command_type == 'C_FUNCTION':
-                    code = writer.write_function(parser.arg1(), int(parser.arg2()))
-                elif command_type == 'C_CALL':
-                    code = writer.write_call(parser.arg1(), parser.arg2())
-                elif command_type == 'C_RETURN':
-                    code = writer.write_return()
-                else:
-                    raise NameError(f"No Command Type: {command_type}")
-                
-                # Write translated code to assembly file
-                asm_file.write(code)
-                #asm_file.write('// ' + ' '.join(parser.current_command) + '\n' + code) include comments
-
-            # Don't forget to close vm file
-            parser.vm_file.close()
-    print(vm_file_path + ' translated to ' + asm_file_path)
+    if output_format == 'asm' or dump_asm:
+        with open(asm_file_path, 'w') as asm_file:
+            asm_file.write(''.join(codes))
+
+    if output_format == 'asm':
+        print(vm_file_path + ' translated to ' + asm_file_path)
+    else:
+        # The generated lines are already clean (but for the tags of cost accounting), so the assembler takes them as they are
+        Assembler = load_assembler()
+        instructions = Assembler.translate(Assembler.CommandParser(line for code in codes for line in code.split('\n') if line and line[0] != '/'))
+
+        hack_file_path = Assembler.get_hack_file_path(asm_file_path, '.' + output_format)
+        os.makedirs(os.path.dirname(hack_file_path), exist_ok=True)
+        with open(hack_file_path, 'wb' if output_format == 'bin' else 'w') as hack_file:
+            Assembler.write_hack(instructions, hack_file, output_format)
+        print(vm_file_path + ' translated to ' + hack_file_path + f' ({len(instructions)} words)')
+        if dump_asm:
+            print('assembly written to ' + asm_file_path)
+    if prune_functions:
+        print(prune_report)
+    if inliner is not None:
+        print(inliner.report())
+    if promoter is not None:
+        print(promoter.report())
+    if optimizer is not None:
+        print(optimizer.report())
+    if fuser is not None:
+        print(fuser.report())
+    if account is not None:
+        print(account.report())
 
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser(description="Translate an VM file into assembly")
     parser.add_argument('vm_file_path', type=str, help="The input VM file")
+    parser.add_argument('--compact', action='store_true', help="Jump to shared call, return and comparison routines instead of inlining them (smaller ROM, a few more cycles)")
+    parser.add_argument('--tos-cache', action='store_true', help="Keep the top of the stack in the D register between commands, spilling it only at labels, jumps, calls and returns")
+    parser.add_argument('-O', '--optimize', action='store_true', help="Fold constants and rewrite redundant VM command sequences before translating, and report what each rule saved")
+    parser.add_argument('-j', '--jobs', type=int, nargs='?', default=1, const=None, help="Translate files in this many worker processes (-j alone: number of cores)")
+    parser.add_argument('--prune', action='store_true', help="Leave out functions that are never called (directly or not) from Sys.init")
+    parser.add_argument('--inline', type=int, nargs='?', default=0, const=16, metavar='SIZE', help="Inline calls to functions without calls of at most SIZE commands (default 16)")
+    parser.add_argument('--inline-growth', type=float, default=20, metavar='PERCENT', help="How much inlining may grow each file (default 20%%)")
+    parser.add_argument('--fuse', action='store_true', help="Translate common command sequences (increments, compare and branch, moves) as superinstructions, and report how often each fired")
+    parser.add_argument('--format', dest='output_format', choices=['asm', 'hack', 'bin'], default='asm', help="Assembly (.asm), or machine code assembled in process into Hack/ as text (.hack) or packed big endian 16 bit words (.bin)")
+    parser.add_argument('--asm', dest='dump_asm', action='store_true', help="Also write the .asm file with the hack and bin formats (for debugging)")
+    parser.add_argument('--intrinsics', action='store_true', help="Translate calls to Math.multiply, Math.divide, Memory.peek and Memory.poke inline, without a call frame")
+    parser.add_argument('--costs', dest='account_costs', action='store_true', help="Tag the code of every VM command with it, and report code size and best case cycles per command kind, function and file")
+    parser.add_argument('--promote-leaves', action='store_true', help="Keep the locals and arguments of functions without calls at fixed addresses instead of their frame")
     
     args = parser.parse_args()
 
-    main(args.vm_file_path)
+    main(args.vm_file_path, compact=args.compact, tos_cache=args.tos_cache, optimize_code=args.optimize, jobs=args.jobs, prune_functions=args.prune,
+         inline_size=args.inline, inline_growth=args.inline_growth / 100, fuse=args.fuse, output_format=args.output_format, dump_asm=args.dump_asm,
+         intrinsics=args.intrinsics, account_costs=args.account_costs, promote_leaves=args.promote_leaves)
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import unittest
+
+import VMTranslator
+
+Assembler = VMTranslator.load_assembler()
+
+def emulate(words, cycles):
+    '''Runs Hack machine code from address 0 for a number of cycles, returns the RAM as a dict of address -> unsigned 16 bit value.'''
+
+    ram = {}
+    pc = a_register = d_register = 0
+    for _ in range(cycles):
+        if pc >= len(words):
+            break
+        word = words[pc]
+        if not word & 0x8000:
+            a_register = word
+            pc += 1
+            continue
+
+        # comp bits zx nx zy ny f no, with y from M if the a bit is set
+        control = (word >> 6) & 63
+        x = d_register
+        y = ram.get(a_register, 0) if word & 0x1000 else a_register
+        if control & 32:
+            x = 0
+        if control & 16:
+            x = ~x & 0xFFFF
+        if control & 8:
+            y = 0
+        if control & 4:
+            y = ~y & 0xFFFF
+        out = (x + y) & 0xFFFF if control & 2 else x & y
+        if control & 1:
+            out = ~out & 0xFFFF
+
+        negative, zero = out & 0x8000, out == 0
+        jump = (word & 4 and negative) or (word & 2 and zero) or (word & 1 and not negative and not zero)
+        address = a_register
+        if word & 8:
+            ram[address] = out
+        if word & 32:
+            a_register = out
+        if word & 16:
+            d_register = out
+        pc = a_register if jump else pc + 1
+    return ram
+
+def run(sources, cycles=5000, inline_size=0, **options):
+    '''Translates VM files given as {name: code} with the translate_file() options, links them behind the bootstrap, assembles and runs them.
+    With an inline_size, calls to functions of at most that many commands are inlined without a growth limit.
+    '''
+
+    codes = [VMTranslator.CodeWriter(options.get('compact', False), options.get('tos_cache', False)).write_init()]
+    with tempfile.TemporaryDirectory() as directory:
+        vm_file_paths = []
+        for name, source in sorted(sources.items()):
+            vm_file_paths.append(os.path.join(directory, name + '.vm'))
+            with open(vm_file_paths[-1], 'w') as vm_file:
+                vm_file.write(source)
+
+        if inline_size:
+            options['inline'] = VMTranslator.inline_candidates(vm_file_paths, inline_size), 100
+        for vm_file_path in vm_file_paths:
+            codes.append(VMTranslator.translate_file(vm_file_path, **options).code)
+
+    lines = [line for code in codes for line in code.split('\n') if line and line[0] != '/']
+    return emulate(list(Assembler.translate(Assembler.CommandParser(lines))), cycles)
+
+# Option combinations the programs are run with
+option_sets = [
+    {},
+    {'optimize_code': True},
+    {'optimize_code': True, 'tos_cache': True},
+    {'optimize_code': True, 'fuse': True},
+    {'optimize_code': True, 'compact': True}
+]
+
+class BranchTest(unittest.TestCase):
+    '''Branches behave the same with and without the optimizer's rewrites.'''
+
+    def test_not_if_goto_on_non_boolean(self):
+        # not is bitwise, so not 5 is true and the branch is taken (Jack emits not, if-goto for every if and while)
+        source = '\n'.join([
+            'function Sys.init 0',
+            'push constant 5',
+            'pop static 1',
+            'push static 1',
+            'not',
+            'if-goto TAKEN',
+            'push constant 1',
+            'pop static 2',
+            'label END',
+            'goto END',
+            'label TAKEN',
+            'push constant 2',
+            'pop static 2',
+            'goto END'
+        ])
+        for options in option_sets:
+            with self.subTest(**options):
+                # Sys.1 and Sys.2 are the first variables, at 16 and 17
+                self.assertEqual(run({'Sys': source}, **options).get(17), 2)
+
+class InlinerTest(unittest.TestCase):
+    '''Inlined calls compute the same as real ones.'''
+
+    def test_callee_with_end_label_and_returns(self):
+        # The callee's own end label must not be confused with the end of the inlined code its returns jump to
+        sources = {
+            'Main': '\n'.join([
+                'function Main.pick 0',
+                'push argument 0',
+                'if-goto end',
+                'push constant 9',
+                'return',
+                'label end',
+                'push constant 209',
+                'return'
+            ]),
+            'Sys': '\n'.join([
+                'function Sys.init 0',
+                'push constant 0',
+                'not',
+                'call Main.pick 1',
+                'pop static 0',
+                'push constant 0',
+                'call Main.pick 1',
+                'pop static 1',
+                'label END',
+                'goto END'
+            ])
+        }
+        for options in option_sets:
+            with self.subTest(**options):
+                ram = run(sources, inline_size=20, **options)
+                self.assertEqual((ram.get(16), ram.get(17)), (209, 9))
+
+if __name__ == '__main__':
+    unittest.main()